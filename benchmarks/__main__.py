@@ -0,0 +1,101 @@
+from argparse import ArgumentParser
+import json
+import sys
+from .suite import MODELS, compare, run
+
+
+def parser_init():
+    parser = ArgumentParser(prog='python -m benchmarks')
+    parser.add_argument(
+        '-u',
+        '--users',
+        metavar='N',
+        type=int,
+        nargs='+',
+        default=[100, 1000],
+        help='numbers of users (up to 100000 for the full suite)')
+    parser.add_argument(
+        '-i',
+        '--items',
+        metavar='N',
+        type=int,
+        nargs='+',
+        default=[200, 2000],
+        help='numbers of items (up to 50000 for the full suite)')
+    parser.add_argument(
+        '-l',
+        '--practice-length',
+        metavar='N',
+        type=int,
+        nargs='+',
+        dest='practice_length',
+        default=[50],
+        help='practice lengths')
+    parser.add_argument(
+        '-m',
+        '--models',
+        metavar='MODEL',
+        nargs='+',
+        choices=sorted(MODELS.keys()),
+        default=sorted(MODELS.keys()),
+        help='models to be benchmarked')
+    parser.add_argument(
+        '--full',
+        action='store_true',
+        help='use the full grid of users (100 - 100000) and items (200 - 50000)')
+    parser.add_argument(
+        '-r',
+        '--repeat',
+        metavar='N',
+        type=int,
+        default=3,
+        help='number of timed runs of each case, the best one is reported')
+    parser.add_argument(
+        '-o',
+        '--output',
+        metavar='FILE',
+        help='path to the JSON file where the results will be saved')
+    parser.add_argument(
+        '-c',
+        '--compare',
+        metavar='FILE',
+        help='path to the JSON file with previous results to compare with')
+    parser.add_argument(
+        '-t',
+        '--threshold',
+        metavar='RATIO',
+        type=float,
+        default=0.1,
+        help='relative slowdown reported as a regression')
+    return parser
+
+
+def main():
+    args = parser_init().parse_args()
+    if args.full:
+        args.users = [100, 1000, 10000, 100000]
+        args.items = [200, 2000, 50000]
+
+    def _log(result):
+        print(' -- %-18s %-14s users: %-7s items: %-6s length: %-4s %10.4f s %12.0f ops/s' % (
+            result['case'], result['model'], result['users'], result['items'],
+            result['practice_length'], result['seconds'], result['ops_per_sec'] or 0))
+
+    results = run(args.users, args.items, args.practice_length, args.models, repeat=args.repeat, log=_log)
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump({'results': results}, f, indent=2)
+        print(' -- saving', args.output)
+    if args.compare is not None:
+        with open(args.compare, 'r') as f:
+            previous = json.loads(f.read())['results']
+        regressions = 0
+        for key, old, new, ratio, regression in compare(results, previous, threshold=args.threshold):
+            print('%-60s %10.4f s -> %10.4f s (%5.2fx)%s' % (key, old, new, ratio, ' REGRESSION' if regression else ''))
+            regressions += regression
+        if regressions > 0:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
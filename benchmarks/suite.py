@@ -0,0 +1,206 @@
+from proso.model import ClusterEloModel, ConstantModel, NaiveModel, NoiseModel, OptimalModel
+from proso.persistence import Writer
+from proso.practice import PracticeLog
+from proso.scenario import Scenario
+from proso.simulator import Simulator
+import gc
+import itertools
+import os
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+
+MODELS = {
+    'optimal': lambda scenario: OptimalModel(scenario.skills(), scenario.difficulties(), scenario.clusters()),
+    'optimal-noise': lambda scenario: OptimalModel(scenario.skills(), scenario.difficulties(), scenario.clusters(), noise=0.1),
+    'elo': lambda scenario: ClusterEloModel(scenario, clusters={}),
+    'elo-clusters': lambda scenario: ClusterEloModel(scenario, clusters=scenario.clusters()),
+    'naive': lambda scenario: NaiveModel(),
+    'constant': lambda scenario: ConstantModel(scenario.target_probability()),
+    'noise': lambda scenario: NoiseModel(NaiveModel(), 0.1),
+}
+
+
+def scenario_config(number_of_users, number_of_items, practice_length):
+    return {
+        'name': 'benchmark',
+        'number_of_items': number_of_items,
+        'number_of_users': number_of_users,
+        'skills': [{'mean': 0, 'std': 1}, {'mean': 0, 'std': 1}],
+        'difficulty': {'mean': 0, 'std': 1},
+        'parameters': {
+            'elo': {'alpha': 0.25, 'beta': 0.01},
+            'elo_clusters': {'alpha': 0.5, 'beta': 0.04},
+        },
+        'wrong_clusters': {'affected_clusters': [0, 1], 'number_of_items': 0},
+        'practice_length': practice_length,
+        'target_probability': 0.75,
+        'seed': 0,
+    }
+
+
+def measure(fun, ops, repeat=3):
+    """
+    Run the function (which gets a fresh state from its setup part, see
+    the cases below) several times and return the best wall time together
+    with the memory statistics of one traced run. The memory is the peak of
+    the traced allocations of the run itself, the process-wide peak RSS
+    would only grow from case to case. The retained blocks are the memory
+    blocks allocated by the run and still alive after it (freed blocks are
+    not counted, so it is not the number of allocations made).
+    """
+    times = []
+    for _ in range(repeat):
+        run = fun()
+        gc.collect()
+        start = time.perf_counter()
+        run()
+        times.append(time.perf_counter() - start)
+    run = fun()
+    gc.collect()
+    blocks = sys.getallocatedblocks()
+    tracemalloc.start()
+    run()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    seconds = min(times)
+    return {
+        'seconds': seconds,
+        'ops': ops,
+        'ops_per_sec': ops / seconds if seconds > 0 else None,
+        'peak_traced_bytes': peak,
+        'retained_blocks': sys.getallocatedblocks() - blocks,
+    }
+
+
+def simulator_cases(scenario, model_name):
+    """
+    Yield (case name, number of operations, setup) for the hot paths of a
+    simulator, setup returns the function to be measured.
+    """
+    practice_length = scenario.practice_length()
+    number_of_users = scenario.number_of_users()
+    attempts = number_of_users * practice_length
+
+    def _simulator():
+        model = MODELS[model_name](scenario)
+        return Simulator(MODELS['optimal'](scenario), model, scenario)
+
+    simulator = _simulator()
+    simulator.get_practice()
+    baseline = scenario.optimal_simulator()
+    baseline.get_practice()
+
+    def _simulate():
+        fresh = _simulator()
+        return lambda: fresh._simulate(PracticeLog(), practice_length)
+
+    def _replay():
+        simulator._replay = {}
+        return lambda: simulator.replay(MODELS[model_name](scenario))
+
+    def _intersection():
+        simulator._intersection = {}
+        return lambda: simulator.intersection_curve()
+
+    def _jaccard():
+        simulator._jaccard = {}
+        return lambda: simulator.jaccard_curve(baseline=baseline)
+
+    def _number_of_answers():
+        simulator._number_of_answers = None
+        simulator._answer_counts = {}
+        return lambda: simulator.number_of_answers()
+
+    directory = tempfile.mkdtemp()
+
+    def _write_practice():
+        writer = Writer()
+        simulator._save_practice(directory, writer)
+        writer.flush()
+
+    def _save_practice():
+        shutil.rmtree(directory)
+        os.makedirs(directory)
+        return _write_practice
+
+    def _load_practice():
+        _write_practice()
+        fresh = _simulator()
+        fresh._directory = directory
+        return lambda: fresh._load_practice()
+
+    yield 'simulate', attempts, _simulate
+    yield 'replay', attempts, _replay
+    yield 'intersection', number_of_users, _intersection
+    yield 'jaccard', number_of_users, _jaccard
+    yield 'number_of_answers', attempts, _number_of_answers
+    yield 'save_practice', attempts, _save_practice
+    yield 'load_practice', attempts, _load_practice
+    shutil.rmtree(directory, ignore_errors=True)
+
+
+def scenario_cases(config):
+    directory = tempfile.mkdtemp()
+    scenario = Scenario(dict(config))
+    scenario.skills()
+    scenario.difficulties()
+    scenario.clusters()
+    scenario.save(directory)
+
+    def _load():
+        fresh = Scenario(dict(config))
+        return lambda: fresh.load(directory)
+
+    yield 'scenario_load', config['number_of_users'], _load
+    shutil.rmtree(directory, ignore_errors=True)
+
+
+def run(users, items, practice_lengths, models, repeat=3, log=None):
+    """
+    Run the benchmarks for all the combinations of the parameters and
+    return the list of results.
+    """
+    results = []
+
+    def _record(parameters, cases):
+        for case, ops, setup in cases:
+            result = dict(parameters, case=case)
+            result.update(measure(setup, ops, repeat=repeat))
+            results.append(result)
+            if log is not None:
+                log(result)
+
+    for number_of_users, number_of_items, practice_length in itertools.product(users, items, practice_lengths):
+        if practice_length > number_of_items:
+            continue
+        config = scenario_config(number_of_users, number_of_items, practice_length)
+        parameters = {'users': number_of_users, 'items': number_of_items, 'practice_length': practice_length}
+        _record(dict(parameters, model=None), scenario_cases(config))
+        scenario = Scenario(dict(config))
+        for model_name in models:
+            _record(dict(parameters, model=model_name), simulator_cases(scenario, model_name))
+    return results
+
+
+def result_key(result):
+    return '%s/%s/%s/%s/%s' % (result['case'], result['model'], result['users'], result['items'], result['practice_length'])
+
+
+def compare(results, previous, threshold=0.1):
+    """
+    Compare the results with the previous ones and return the list of
+    (key, previous seconds, current seconds, ratio, regression flag).
+    """
+    previous = dict([(result_key(r), r) for r in previous])
+    comparison = []
+    for result in results:
+        old = previous.get(result_key(result))
+        if old is None or old['seconds'] == 0:
+            continue
+        ratio = result['seconds'] / old['seconds']
+        comparison.append((result_key(result), old['seconds'], result['seconds'], ratio, ratio > 1 + threshold))
+    return comparison
@@ -0,0 +1,245 @@
+from .model import OptimalModel
+from .replication import bootstrap
+from os import path, makedirs
+import csv
+import hashlib
+import json
+import numpy
+
+
+def noise_simulators(scenario, destination, std_step=0.01, std_max=0.35):
+    result = []
+    for std in numpy.arange(0, std_max, std_step):
+        # each level has its own noise derived from the seed of the scenario
+        seed = int(scenario.random_generator('noise', '%.2f' % std).integers(2 ** 63))
+        model = OptimalModel(scenario.skills(), scenario.difficulties(), scenario.clusters(), noise=std, seed=seed)
+        result.append((std, scenario.init_simulator(destination, model)))
+    return result
+
+
+def intersection_trends(scenario, simulators):
+    """
+    Return {simulator name: size of the intersection with the optimal
+    practiced set after each attempt} for all the non-optimal simulators.
+    The intersections already stored by the simulators (e.g. accumulated
+    by the streaming simulation) are used, the curve is computed from the
+    practice only if some of them are missing.
+    """
+    names = [name for name in simulators.keys() if name != 'Optimal']
+    trends = scenario.read(_cache_key('plot_intersection__trends', simulators))
+    if trends is None:
+        trends = []
+        lengths = range(1, scenario.practice_length() + 1)
+        for name in names:
+            simulator = simulators[name]
+            if all([length in simulator._intersection for length in lengths]):
+                intersection = [simulator.intersection(length)[0] for length in lengths]
+            else:
+                intersection = simulator.intersection_curve(scenario.practice_length())[0].tolist()
+            trends.append(intersection)
+            print(name, intersection[-1])
+        scenario.write(_cache_key('plot_intersection__trends', simulators), trends)
+    return dict(zip(names, trends))
+
+
+def rmse_matrix(scenario, simulators):
+    """
+    Return {model: {data set: RMSE}}, each model is replayed on the practice
+    of each simulator (starting from the warm start of its simulator).
+    """
+    result = dict([(name, {}) for name in simulators.keys()])
+    names, models, warm_starts = list(zip(*[(name, simulator._model, simulator.warm_start()) for name, simulator in simulators.items()]))
+    for data_name, data_provider in simulators.items():
+        for name, current_rmse in zip(names, data_provider.replay_many(models, warm_starts=warm_starts)):
+            result[name][data_name] = current_rmse
+    scenario.write(_cache_key('plot_rmse_complex__rmse', simulators), result)
+    return result
+
+
+def answers_per_difficulty(simulators, bins=10):
+    """
+    Return the edges of the true probability bins and {simulator name:
+    number of answers in each bin}.
+    """
+    counts = {}
+    edges = None
+    for name, simulator in sorted(simulators.items()):
+        counts[name], edges = simulator.answers_per_probability(bins=bins)
+    return edges, counts
+
+
+def answer_distributions(simulators):
+    """
+    Return {simulator name: numbers of answers of the items sorted in the
+    descending order}.
+    """
+    return dict([(name, numpy.sort(simulator.answer_counts())[::-1]) for name, simulator in sorted(simulators.items())])
+
+
+def noise_sweep(scenario, destination, std_step=0.01, std_max=0.35):
+    """
+    Return the lists of noise levels, RMSEs and intersection sizes of the
+    noisy optimal simulators.
+    """
+    stds = []
+    rmses = []
+    intersections = []
+    for std, simulator in noise_simulators(scenario, destination, std_step=std_step, std_max=std_max):
+        stds.append(std)
+        rmses.append(simulator.rmse())
+        intersections.append(simulator.intersection()[0])
+    return stds, rmses, intersections
+
+
+def replicate(scenario, simulators, destination, number_of_replicas):
+    """
+    Return {simulator name: list of the simulator and its replicas}, see
+    Scenario.replicas. The replicas are registered in the scenario, so
+    Scenario.simulate simulates them (in parallel).
+    """
+    # the replicas of the optimal simulator are the baselines of the others
+    names = sorted(simulators.keys(), key=lambda name: name != 'Optimal')
+    return dict([(name, scenario.replicas(destination, simulators[name], number_of_replicas)) for name in names])
+
+
+def confidence_intervals(scenario, replicas, resamples=1000, confidence=0.95):
+    """
+    Return the estimates and the bootstrap confidence intervals (resampling
+    both the replicas and the users) of the intersection and Jaccard trends
+    of the non-optimal simulators and of the RMSE matrix (see rmse_matrix)
+    given {simulator name: list of replicas} returned by replicate.
+    """
+    simulators = dict([(name, simulator_replicas[0]) for name, simulator_replicas in replicas.items()])
+    number_of_replicas = len(next(iter(replicas.values())))
+    key = _cache_key('replication__%s_%s_%s' % (number_of_replicas, resamples, confidence), simulators)
+    result = scenario.read(key)
+    if result is not None:
+        return result
+    random_generator = scenario.random_generator('bootstrap', number_of_replicas)
+
+    def _bounds(estimate, lower, upper):
+        return {'estimate': estimate.tolist(), 'lower': lower.tolist(), 'upper': upper.tolist()}
+
+    result = {'replicas': number_of_replicas, 'resamples': resamples, 'confidence': confidence}
+    names = sorted([name for name in replicas.keys() if name != 'Optimal'])
+    similarity = dict([(name, [simulator.user_similarity(scenario.practice_length()) for simulator in replicas[name]]) for name in names])
+    for i, metric in enumerate(['intersection', 'jaccard']):
+        # replicas x users x simulators x practice length
+        values = numpy.stack([
+            numpy.stack([similarity[name][replica][i] for name in names], axis=1)
+            for replica in range(number_of_replicas)])
+        estimate, lower, upper = bootstrap(values, resamples=resamples, confidence=confidence, random_generator=random_generator)
+        result[metric] = dict([(name, _bounds(estimate[j], lower[j], upper[j])) for j, name in enumerate(names)])
+    names = sorted(replicas.keys())
+    models = [simulators[name]._model for name in names]
+    warm_starts = [simulators[name].warm_start() for name in names]
+    # replicas x users x data sets x models
+    errors, attempts = [], []
+    for data_replicas in zip(*[replicas[name] for name in names]):
+        replica_errors = [data_provider.user_replay_errors(models, warm_starts=warm_starts) for data_provider in data_replicas]
+        errors.append(numpy.stack([e.T for e, _ in replica_errors], axis=1))
+        attempts.append(numpy.stack([numpy.repeat(a[:, None], len(models), axis=1) for _, a in replica_errors], axis=1))
+    estimate, lower, upper = bootstrap(
+        numpy.stack(errors), weights=numpy.stack(attempts), resamples=resamples, confidence=confidence, random_generator=random_generator)
+    estimate, lower, upper = numpy.sqrt(estimate), numpy.sqrt(lower), numpy.sqrt(upper)
+    result['rmse'] = dict([
+        (name, dict([(data_name, _bounds(estimate[d, m], lower[d, m], upper[d, m])) for d, data_name in enumerate(names)]))
+        for m, name in enumerate(names)])
+    scenario.write(key, result)
+    return result
+
+
+def compute_all(scenario, simulators, destination, skip_groups=None, replicas=None, resamples=1000):
+    """
+    Compute the data behind all the figures of the scenario as a JSON
+    serializable dictionary. If the replicas of the simulators are given
+    (see replicate), the confidence intervals are computed as well.
+    """
+    result = {}
+    if skip_groups is None or 'common' not in skip_groups:
+        result['intersection'] = intersection_trends(scenario, simulators)
+        result['rmse'] = rmse_matrix(scenario, simulators)
+        if replicas is not None:
+            result['confidence_intervals'] = confidence_intervals(scenario, replicas, resamples=resamples)
+        edges, counts = answers_per_difficulty(simulators)
+        result['answers_per_difficulty'] = {
+            'edges': edges.tolist(),
+            'counts': dict([(name, c.tolist()) for name, c in counts.items()]),
+        }
+    if skip_groups is None or 'noise' not in skip_groups:
+        stds, rmses, intersections = noise_sweep(scenario, destination)
+        result['noise'] = {
+            'std': [float(std) for std in stds],
+            'rmse': [float(r) for r in rmses],
+            'intersection': [float(i) for i in intersections],
+        }
+        result['answer_distribution'] = dict([(name, c.tolist()) for name, c in answer_distributions(simulators).items()])
+    return result
+
+
+def export(metrics, directory):
+    """
+    Save the metrics computed by compute_all to metrics.json and one CSV
+    file per figure in the given directory, return the created files.
+    """
+    if not path.exists(directory):
+        makedirs(directory)
+    filenames = [directory + '/metrics.json']
+    with open(filenames[0], 'w') as f:
+        json.dump(metrics, f, indent=2, sort_keys=True)
+
+    def _write_csv(name, header, rows):
+        filenames.append(directory + '/' + name + '.csv')
+        with open(filenames[-1], 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(header)
+            writer.writerows(rows)
+
+    if 'intersection' in metrics:
+        names = sorted(metrics['intersection'].keys())
+        _write_csv('intersection', ['attempt'] + names, [
+            [i] + [metrics['intersection'][n][i] for n in names]
+            for i in range(len(metrics['intersection'][names[0]]) if names else 0)])
+    if 'rmse' in metrics:
+        _write_csv('rmse', ['model', 'data_set', 'rmse'], [
+            [model, data_set, value]
+            for model, model_rmse in sorted(metrics['rmse'].items())
+            for data_set, value in sorted(model_rmse.items())])
+    if 'confidence_intervals' in metrics:
+        intervals = metrics['confidence_intervals']
+        names = sorted(intervals['intersection'].keys())
+        _write_csv('intersection_ci', ['attempt'] + ['%s (%s)' % (n, b) for n in names for b in ['estimate', 'lower', 'upper']], [
+            [i] + [intervals['intersection'][n][b][i] for n in names for b in ['estimate', 'lower', 'upper']]
+            for i in range(len(intervals['intersection'][names[0]]['estimate']) if names else 0)])
+        _write_csv('rmse_ci', ['model', 'data_set', 'estimate', 'lower', 'upper'], [
+            [model, data_set, bounds['estimate'], bounds['lower'], bounds['upper']]
+            for model, model_rmse in sorted(intervals['rmse'].items())
+            for data_set, bounds in sorted(model_rmse.items())])
+    if 'answers_per_difficulty' in metrics:
+        edges = metrics['answers_per_difficulty']['edges']
+        counts = metrics['answers_per_difficulty']['counts']
+        names = sorted(counts.keys())
+        _write_csv('answers_per_difficulty', ['lower', 'upper'] + names, [
+            [edges[i], edges[i + 1]] + [counts[n][i] for n in names]
+            for i in range(len(edges) - 1)])
+    if 'noise' in metrics:
+        noise = metrics['noise']
+        _write_csv('noise', ['std', 'rmse', 'intersection'], list(zip(noise['std'], noise['rmse'], noise['intersection'])))
+    if 'answer_distribution' in metrics:
+        distributions = metrics['answer_distribution']
+        names = sorted(distributions.keys())
+        _write_csv('answer_distribution', ['rank'] + names, [
+            [i] + [distributions[n][i] for n in names]
+            for i in range(max([len(d) for d in distributions.values()] or [0]))])
+    return filenames
+
+
+def _cache_key(key, simulators):
+    """
+    Distinguish the values cached in the scenario for the warm started
+    simulators from the ones for the simulators starting from scratch.
+    """
+    warm_starts = sorted(set([simulator.warm_start()[0] for simulator in simulators.values() if simulator.warm_start() is not None]))
+    if len(warm_starts) == 0:
+        return key
+    return '%s__warm_start_%s' % (key, hashlib.sha1('|'.join(warm_starts).encode()).hexdigest())
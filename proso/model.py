@@ -1,19 +1,155 @@
 import abc
+import hashlib
 import math
+import numpy
 import random
-from collections import defaultdict
+from .util import ArrayDict, dict_to_array
 
 
 def predict(skill):
     return 1.0 / (1 + math.exp(-skill))
 
 
+def predict_many(skills):
+    return 1.0 / (1 + numpy.exp(-skills))
+
+
+def _mix(values):
+    # splitmix64 finalizer, the arithmetic wraps around modulo 2 ** 64
+    values = values ^ (values >> numpy.uint64(30))
+    values = values * numpy.uint64(0xBF58476D1CE4E5B9)
+    values = values ^ (values >> numpy.uint64(27))
+    values = values * numpy.uint64(0x94D049BB133111EB)
+    return values ^ (values >> numpy.uint64(31))
+
+
+def permanent_noise(seed, users, items):
+    """
+    Return standard normal deviates determined only by the seed and the
+    (user, item) pairs (users and items are broadcast against each other),
+    so the noise does not have to be stored and does not depend on the
+    order in which the pairs are visited.
+    """
+    golden = numpy.uint64(0x9E3779B97F4A7C15)
+    with numpy.errstate(over='ignore'):
+        users, items = numpy.broadcast_arrays(
+            numpy.asarray(users, dtype=numpy.int64).astype(numpy.uint64),
+            numpy.asarray(items, dtype=numpy.int64).astype(numpy.uint64))
+        state = _mix(_mix(_mix(numpy.uint64(seed) + golden) + users * golden) + items * golden)
+        first = ((state >> numpy.uint64(11)).astype(numpy.float64) + 0.5) / 2.0 ** 53
+        second = (_mix(state + golden) >> numpy.uint64(11)).astype(numpy.float64) / 2.0 ** 53
+    return numpy.sqrt(-2 * numpy.log(first)) * numpy.cos(2 * math.pi * second)
+
+
+def default_noise_seed(name):
+    """
+    Return the seed of the permanent noise of the model with the given name,
+    so the models with different levels of noise (or a noise model wrapping
+    a noisy model) do not share the deviates.
+    """
+    return int(hashlib.sha1(name.encode()).hexdigest(), 16) % 2 ** 63
+
+
+def common_uniforms(seed, users, items):
+    """
+    Return uniform deviates from [0, 1) determined only by the seed and the
+    (user, item) pairs (users and items are broadcast against each other),
+    so all the simulators using the same seed draw the same number for the
+    same answer.
+    """
+    golden = numpy.uint64(0x9E3779B97F4A7C15)
+    with numpy.errstate(over='ignore'):
+        users, items = numpy.broadcast_arrays(
+            numpy.asarray(users, dtype=numpy.int64).astype(numpy.uint64),
+            numpy.asarray(items, dtype=numpy.int64).astype(numpy.uint64))
+        state = _mix(_mix(_mix(numpy.uint64(seed) + golden) + users * golden) + items * golden)
+    return (state >> numpy.uint64(11)).astype(numpy.float64) / 2.0 ** 53
+
+
+def _item_array(values, default=0):
+    """
+    Turn a dict keyed by (non-negative integer) item ids into an array
+    indexed by the item id.
+    """
+    if isinstance(values, ArrayDict):
+        return numpy.asarray(values.array, dtype=numpy.float64)
+    result = numpy.full(max(values.keys(), default=-1) + 1, default, dtype=numpy.float64)
+    for item, value in values.items():
+        result[item] = value
+    return result
+
+
+def _resized(values, size):
+    """
+    Return a copy of the array enlarged along the first axis and padded with
+    zeros.
+    """
+    result = numpy.zeros((size,) + values.shape[1:], dtype=values.dtype)
+    result[:len(values)] = values
+    return result
+
+
 class Model:
 
     @abc.abstractmethod
     def predict(self, user, item):
         pass
 
+    def predict_many(self, user, items):
+        """
+        Predict the probability of the correct answer for the given user and
+        all the given items at once. Returns an array aligned with the items.
+        """
+        return numpy.array([self.predict(user, i) for i in items], dtype=numpy.float64)
+
+    def predict_matrix(self, users, items):
+        """
+        Return users x items matrix of predictions.
+        """
+        return numpy.array([self.predict_many(u, items) for u in users], dtype=numpy.float64).reshape(len(users), len(items))
+
+    def learns(self):
+        """
+        Return False if the model ignores updates, so the predictions for
+        one user do not depend on the answers of any other user.
+        """
+        return True
+
+    def monotone_items(self):
+        """
+        Return the arrays of item clusters and item difficulties (both indexed
+        by item) if the prediction for any user is non-increasing in the item
+        difficulty within each cluster, None otherwise.
+        """
+        return None
+
+    def snapshot(self):
+        """
+        Return the learned state of the model as a dict of arrays (see
+        restore), or None if the model does not support it.
+        """
+        if not self.learns():
+            return {}
+        return None
+
+    def item_snapshot(self):
+        """
+        Return the part of the snapshot describing only the items, which
+        can be carried over to other users (see restore), or None if the
+        model does not support it.
+        """
+        if not self.learns():
+            return {}
+        return None
+
+    def restore(self, snapshot):
+        """
+        Set the learned state of the model to the one returned by snapshot.
+        The state of the users is kept if the snapshot is returned by
+        item_snapshot.
+        """
+        pass
+
     @abc.abstractmethod
     def update(self, user, item, correct):
         pass
@@ -25,19 +161,44 @@ class Model:
 
 class OptimalModel(Model):
 
-    def __init__(self, users, items, clusters, noise=None):
+    def __init__(self, users, items, clusters, noise=None, seed=None):
         self._users = users
         self._items = items
         self._clusters = clusters
         self._noise_value = noise
-        noise_fun = lambda: 0
-        if self._noise_value is not None:
-            noise_fun = lambda: random.gauss(0, self._noise_value)
-        self._noise = defaultdict(noise_fun)
+        self._seed = seed
+        self._noise_seed = seed if seed is not None else default_noise_seed(str(self))
+        self._init_arrays()
 
     def predict(self, user, item):
-        cluster = self._clusters[item]
-        return predict(self._users[user][cluster] - self._items[item] + self._noise[user, item])
+        # numpy.exp (unlike math.exp) gives the same values as in
+        # predict_many and predict_matrix, so all the simulation modes agree
+        return float(predict_many(
+            self._skills_array[user, self._clusters_array[item]] - self._difficulties_array[item] + self._noise(user, item)))
+
+    def predict_many(self, user, items):
+        items = numpy.asarray(items, dtype=numpy.int64)
+        skills = self._skills_array[user, self._clusters_array[items]]
+        values = skills - self._difficulties_array[items]
+        if self._noise_value is not None:
+            values += self._noise_value * permanent_noise(self._noise_seed, user, items)
+        return predict_many(values)
+
+    def predict_matrix(self, users, items):
+        users = numpy.asarray(users, dtype=numpy.int64)
+        items = numpy.asarray(items, dtype=numpy.int64)
+        values = self._skills_array[users[:, None], self._clusters_array[items][None, :]] - self._difficulties_array[items]
+        if self._noise_value is not None:
+            values += self._noise_value * permanent_noise(self._noise_seed, users[:, None], items[None, :])
+        return predict_many(values)
+
+    def learns(self):
+        return False
+
+    def monotone_items(self):
+        if self._noise_value is not None:
+            return None
+        return self._clusters_array, self._difficulties_array
 
     def update(self, user, item, correct):
         pass
@@ -45,10 +206,33 @@ class OptimalModel(Model):
     def reset(self):
         pass
 
+    def _noise(self, user, item):
+        if self._noise_value is None:
+            return 0
+        return self._noise_value * float(permanent_noise(self._noise_seed, user, item))
+
+    def _init_arrays(self):
+        self._skills_array = dict_to_array(self._users, numpy.float64).reshape(len(self._users), -1)
+        self._difficulties_array = _item_array(self._items)
+        self._clusters_array = _item_array(self._clusters).astype(numpy.int64)
+
+    def __getstate__(self):
+        # the arrays are derived from the dicts, which may be shared
+        state = dict(self.__dict__)
+        for key in ['_skills_array', '_difficulties_array', '_clusters_array']:
+            del state[key]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._init_arrays()
+
     def __str__(self):
         result = 'optimal'
         if self._noise_value is not None:
             result += ', noise %.2f' % self._noise_value
+            if self._seed is not None:
+                result += ', seed %s' % self._seed
         return result
 
 
@@ -63,45 +247,98 @@ class ClusterEloModel(Model):
                 alpha = scenario.parameter('elo', 'alpha')
                 dynamic_alpha = scenario.parameter('elo', 'beta')
         if number_of_items_with_wrong_cluster > 0:
-            random.seed(sum(map(ord, scenario.config_hash())))
+            # a local generator keeps the choice reproducible without
+            # touching the global random state
+            wrong_random = random.Random(sum(map(ord, scenario.config_hash())))
             if affected_wrong_clusters is None:
                 affected_wrong_clusters = scenario.affected_wrong_clusters()
             wrong_items_cands = [i for (i, c) in clusters.items() if c in affected_wrong_clusters]
-            wrong_items = random.sample(wrong_items_cands, number_of_items_with_wrong_cluster)
+            wrong_items = wrong_random.sample(wrong_items_cands, number_of_items_with_wrong_cluster)
             clusters = dict(list(clusters.items()))
             for i in wrong_items:
                 available_clusters = set(affected_wrong_clusters)
                 available_clusters.remove(clusters[i])
-                clusters[i] = random.choice(list(available_clusters))
-        self._users = {}
-        self._items = {}
+                clusters[i] = wrong_random.choice(list(available_clusters))
         self._clusters = clusters
-        self._answers = {}
+        self._clusters_array = _item_array(clusters).astype(numpy.int64)
+        self._number_of_clusters = int(self._clusters_array.max()) + 1 if len(self._clusters_array) > 0 else 1
         self._alpha = alpha
         self._dynamic_alpha = dynamic_alpha
         self._number_of_items_with_wrong_cluster = number_of_items_with_wrong_cluster
+        self._skills = numpy.zeros((scenario.number_of_users(), self._number_of_clusters), dtype=numpy.float64)
+        self._difficulties = numpy.zeros(scenario.number_of_items(), dtype=numpy.float64)
+        self._user_answers = numpy.zeros(self._skills.shape, dtype=numpy.int64)
+        self._item_answers = numpy.zeros(self._difficulties.shape, dtype=numpy.int64)
+        self._grow(0, max(len(self._clusters_array), len(self._difficulties)) - 1)
 
     def predict(self, user, item):
-        cluster = self._clusters.get(item, 0)
-        return predict(self._users.get((user, cluster), 0) - self._items.get(item, 0))
+        self._grow(user, item)
+        return predict(float(self._skills[user, self._clusters_array[item]] - self._difficulties[item]))
+
+    def predict_many(self, user, items):
+        items = numpy.asarray(items, dtype=numpy.int64)
+        if len(items) > 0:
+            self._grow(user, int(items.max()))
+        return predict_many(self._skills[user, self._clusters_array[items]] - self._difficulties[items])
+
+    def monotone_items(self):
+        return self._clusters_array, self._difficulties
 
     def update(self, user, item, correct):
-        cluster = self._clusters.get(item, 0)
         prediction = self.predict(user, item)
-        user_nums = self._answers.get(('user', user, cluster), 0)
-        item_nums = self._answers.get(('item', item), 0)
-        self._users[user, cluster] = self._users.get((user, cluster), 0) + self.alpha(user_nums) * (correct - prediction)
-        self._items[item] = self._items.get(item, 0) - self.alpha(item_nums) * (correct - prediction)
-        self._answers['user', user, cluster] = user_nums + 1
-        self._answers['item', item] = item_nums + 1
+        cluster = self._clusters_array[item]
+        user_nums = int(self._user_answers[user, cluster])
+        item_nums = int(self._item_answers[item])
+        self._skills[user, cluster] += self.alpha(user_nums) * (correct - prediction)
+        self._difficulties[item] -= self.alpha(item_nums) * (correct - prediction)
+        self._user_answers[user, cluster] = user_nums + 1
+        self._item_answers[item] = item_nums + 1
 
     def alpha(self, n):
         return self._alpha / (1 + self._dynamic_alpha * n)
 
     def reset(self):
-        self._users = {}
-        self._items = {}
-        self._answers = {}
+        self._skills.fill(0)
+        self._difficulties.fill(0)
+        self._user_answers.fill(0)
+        self._item_answers.fill(0)
+
+    def snapshot(self):
+        return {
+            'skills': self._skills.copy(),
+            'difficulties': self._difficulties.copy(),
+            'user_answers': self._user_answers.copy(),
+            'item_answers': self._item_answers.copy(),
+        }
+
+    def item_snapshot(self):
+        return {
+            'difficulties': self._difficulties.copy(),
+            'item_answers': self._item_answers.copy(),
+        }
+
+    def restore(self, snapshot):
+        if 'skills' in snapshot:
+            self._skills = numpy.array(snapshot['skills'], dtype=numpy.float64)
+            self._user_answers = numpy.array(snapshot['user_answers'], dtype=numpy.int64)
+        self._difficulties = numpy.array(snapshot['difficulties'], dtype=numpy.float64)
+        self._item_answers = numpy.array(snapshot['item_answers'], dtype=numpy.int64)
+
+    def _grow(self, user, item):
+        """
+        Make sure the state arrays are large enough to hold the given user and
+        item, the capacity is at least doubled to amortize the reallocations.
+        """
+        if user >= len(self._skills):
+            size = max(user + 1, 2 * len(self._skills))
+            self._skills = _resized(self._skills, size)
+            self._user_answers = _resized(self._user_answers, size)
+        if item >= len(self._difficulties):
+            size = max(item + 1, 2 * len(self._difficulties))
+            self._difficulties = _resized(self._difficulties, size)
+            self._item_answers = _resized(self._item_answers, size)
+        if item >= len(self._clusters_array):
+            self._clusters_array = _resized(self._clusters_array, len(self._difficulties))
 
     def __str__(self):
         result = 'elo cluster (alpha: %.2f, dynamic_alpha: %.2f, wrong: %s)' % (
@@ -114,21 +351,61 @@ class ClusterEloModel(Model):
 class NaiveModel(Model):
 
     def __init__(self):
-        self._means = {}
-        self._nums = {}
+        self.reset()
 
     def predict(self, user, item):
-        return self._means.get(item, 0.5)
+        if item >= len(self._means):
+            return 0.5
+        return float(self._means[item])
+
+    def predict_many(self, user, items):
+        items = numpy.asarray(items, dtype=numpy.int64)
+        if len(items) > 0:
+            self._grow(int(items.max()))
+        return self._means[items]
 
     def update(self, user, item, correct):
-        item_mean = self._means.get(item, 0)
-        item_num = self._nums.get(item, 0) + 1
+        self._grow(item)
+        item_mean = float(self._means[item])
+        item_num = int(self._nums[item]) + 1
         self._nums[item] = item_num
         self._means[item] = float((item_num - 1) * item_mean + correct) / item_num
 
     def reset(self):
-        self._means = {}
-        self._nums = {}
+        # the items not answered yet are predicted by 0.5
+        self._means = numpy.zeros(0, dtype=numpy.float64)
+        self._nums = numpy.zeros(0, dtype=numpy.int64)
+
+    def snapshot(self):
+        items = numpy.flatnonzero(self._nums)
+        return {
+            'items': items,
+            'means': self._means[items],
+            'nums': self._nums[items],
+        }
+
+    def item_snapshot(self):
+        return self.snapshot()
+
+    def restore(self, snapshot):
+        self.reset()
+        items = numpy.asarray(snapshot['items'], dtype=numpy.int64)
+        if len(items) > 0:
+            self._grow(int(items.max()))
+        self._means[items] = snapshot['means']
+        self._nums[items] = snapshot['nums']
+
+    def _grow(self, item):
+        """
+        Make sure the arrays are large enough to hold the given item, the
+        capacity is at least doubled to amortize the reallocations.
+        """
+        if item >= len(self._means):
+            size = max(item + 1, 2 * len(self._means))
+            means = numpy.full(size, 0.5)
+            means[:len(self._means)] = self._means
+            self._means = means
+            self._nums = _resized(self._nums, size)
 
     def __str__(self):
         return 'naive'
@@ -142,6 +419,15 @@ class ConstantModel(Model):
     def predict(self, user, item):
         return self._constant
 
+    def predict_many(self, user, items):
+        return numpy.full(len(items), self._constant, dtype=numpy.float64)
+
+    def predict_matrix(self, users, items):
+        return numpy.full((len(users), len(items)), self._constant, dtype=numpy.float64)
+
+    def learns(self):
+        return False
+
     def update(self, user, item, correct):
         pass
 
@@ -154,13 +440,25 @@ class ConstantModel(Model):
 
 class NoiseModel(Model):
 
-    def __init__(self, model, std):
+    def __init__(self, model, std, seed=None):
         self._model = model
         self._std = std
-        self._noise = defaultdict(lambda: random.gauss(0, self._std))
+        self._seed = seed
+        self._noise_seed = seed if seed is not None else default_noise_seed(str(self))
 
     def predict(self, user, item):
-        return min(max(self._model.predict(user, item) + self._noise[user, item], 0), 1)
+        return min(max(self._model.predict(user, item) + self._std * float(permanent_noise(self._noise_seed, user, item)), 0), 1)
+
+    def predict_many(self, user, items):
+        noise = self._std * permanent_noise(self._noise_seed, user, items)
+        return numpy.clip(self._model.predict_many(user, items) + noise, 0, 1)
+
+    def predict_matrix(self, users, items):
+        noise = self._std * permanent_noise(self._noise_seed, numpy.asarray(users)[:, None], numpy.asarray(items)[None, :])
+        return numpy.clip(self._model.predict_matrix(users, items) + noise, 0, 1)
+
+    def learns(self):
+        return self._model.learns()
 
     def update(self, user, item, correct):
         return self._model.update(user, item, correct)
@@ -168,5 +466,17 @@ class NoiseModel(Model):
     def reset(self):
         return self._model.reset()
 
+    def snapshot(self):
+        return self._model.snapshot()
+
+    def item_snapshot(self):
+        return self._model.item_snapshot()
+
+    def restore(self, snapshot):
+        return self._model.restore(snapshot)
+
     def __str__(self):
-        return 'permanent noise (std: %s): %s' % (self._std, str(self._model))
+        result = 'permanent noise (std: %s): %s' % (self._std, str(self._model))
+        if self._seed is not None:
+            result += ', seed %s' % self._seed
+        return result
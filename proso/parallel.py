@@ -0,0 +1,148 @@
+from multiprocessing import Pool, resource_tracker
+from multiprocessing.shared_memory import SharedMemory
+from .util import ArrayDict, dict_to_array
+import io
+import numpy
+import pickle
+import time
+
+
+_WORKER = {}
+
+
+class _ScenarioPickler(pickle.Pickler):
+    """
+    Replaces the scenarios and their (test set) data by references, so they
+    are not serialized together with every simulator sent to a worker.
+    """
+
+    def __init__(self, file, shared):
+        pickle.Pickler.__init__(self, file, protocol=pickle.HIGHEST_PROTOCOL)
+        self._shared = shared
+
+    def persistent_id(self, obj):
+        return self._shared.get(id(obj))
+
+
+class _ScenarioUnpickler(pickle.Unpickler):
+
+    def persistent_load(self, pid):
+        return _WORKER[pid[0]][pid[1]]
+
+
+def simulate_all(scenario, simulators, jobs, progress=None, checkpoint_every=None):
+    """
+    Simulate the given simulators of the scenario in a pool of processes.
+    Skills, difficulties and clusters of the scenario are passed to the
+    workers through shared memory, the computed practice is stored back to
+    the simulators.
+    """
+    simulate_batch([(scenario, simulators)], jobs=jobs, progress=progress, checkpoint_every=checkpoint_every)
+
+
+def create_pool(jobs):
+    """
+    Create a pool of processes sharing the resource tracker of this process,
+    so the shared memory blocks attached by the workers are not reported as
+    leaked (or unlinked) by trackers of their own.
+    """
+    resource_tracker.ensure_running()
+    return Pool(jobs)
+
+
+def simulate_batch(batch, jobs=1, pool=None, progress=None, checkpoint_every=None):
+    """
+    Simulate the simulators of several scenarios given as a list of
+    (scenario, simulators) in one pool of processes (created for the given
+    number of jobs unless an existing pool is given). The longest
+    simulations (users x items x practice length) are started first. The
+    optional progress function gets the scenario, the simulator, the number
+    of finished and all the simulations and the time of the simulation.
+    The checkpoint interval is passed to Simulator.simulate.
+    """
+    tasks = sorted(
+        [(scenario, simulator) for scenario, simulators in batch for simulator in simulators],
+        key=lambda s_s: -s_s[0].cost())
+    if len(tasks) == 0:
+        return
+    if pool is None and (jobs <= 1 or len(tasks) == 1):
+        for i, (scenario, simulator) in enumerate(tasks):
+            start = time.perf_counter()
+            simulator.simulate(checkpoint_every=checkpoint_every)
+            if progress is not None:
+                progress(scenario, simulator, i + 1, len(tasks), time.perf_counter() - start)
+        return
+    memory = {}
+    try:
+        shared = {}
+        layouts = {}
+        for scenario in set([scenario for scenario, _ in tasks]):
+            key, layouts[id(scenario)] = _share_scenario(scenario, memory)
+            shared[id(scenario)] = (key, 'scenario')
+            shared[id(scenario.skills())] = (key, 'skills')
+            shared[id(scenario.difficulties())] = (key, 'difficulties')
+            shared[id(scenario.clusters())] = (key, 'clusters')
+        payloads = []
+        for i, (scenario, simulator) in enumerate(tasks):
+            buff = io.BytesIO()
+            _ScenarioPickler(buff, shared).dump(simulator)
+            payloads.append((i, scenario._data['config'], layouts[id(scenario)], buff.getvalue(), checkpoint_every))
+        own_pool = pool is None
+        if own_pool:
+            pool = create_pool(min(jobs, len(tasks)))
+        try:
+            for done, (i, practice, seconds) in enumerate(pool.imap_unordered(_simulate, payloads)):
+                scenario, simulator = tasks[i]
+                simulator._practice = practice
+                if progress is not None:
+                    progress(scenario, simulator, done + 1, len(tasks), seconds)
+        finally:
+            if own_pool:
+                pool.close()
+                pool.join()
+    finally:
+        for block in memory.values():
+            block.close()
+            block.unlink()
+
+
+def _share_scenario(scenario, memory):
+    arrays = {
+        'skills': dict_to_array(scenario.skills(), numpy.float64),
+        'difficulties': dict_to_array(scenario.difficulties(), numpy.float64),
+        'clusters': dict_to_array(scenario.clusters(), numpy.int64),
+    }
+    layout = {}
+    for name, array in arrays.items():
+        block = SharedMemory(create=True, size=max(array.nbytes, 1))
+        memory[block.name] = block
+        numpy.ndarray(array.shape, dtype=array.dtype, buffer=block.buf)[:] = array
+        layout[name] = (block.name, array.shape, array.dtype.str)
+    return layout['skills'][0], layout
+
+
+def _worker_scenario(key, config, layout):
+    if key in _WORKER:
+        return
+    from .scenario import Scenario
+    scenario = Scenario(config)
+    test_set = scenario._data['test_set']
+    for name, (block_name, shape, dtype) in layout.items():
+        block = SharedMemory(name=block_name)
+        test_set[name] = ArrayDict(numpy.array(numpy.ndarray(shape, dtype=numpy.dtype(dtype), buffer=block.buf)))
+        block.close()
+    _WORKER[key] = {
+        'scenario': scenario,
+        'skills': test_set['skills'],
+        'difficulties': test_set['difficulties'],
+        'clusters': test_set['clusters'],
+    }
+
+
+def _simulate(task):
+    i, config, layout, payload, checkpoint_every = task
+    _worker_scenario(layout['skills'][0], config, layout)
+    start = time.perf_counter()
+    simulator = _ScenarioUnpickler(io.BytesIO(payload)).load()
+    simulator.simulate(checkpoint_every=checkpoint_every)
+    return i, simulator._practice, time.perf_counter() - start
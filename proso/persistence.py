@@ -0,0 +1,97 @@
+from os import path, makedirs, replace, getpid
+import numpy
+import queue
+import threading
+
+
+def atomic_write(filename, data):
+    """
+    Write the data (a string, a numpy array saved in the npy format, or a
+    dict of arrays saved in the npz format) to
+    a temporary file which then replaces the given one, so readers never
+    see a partially written file.
+    """
+    directory = path.dirname(filename)
+    if directory and not path.exists(directory):
+        makedirs(directory)
+    tmp_filename = '%s.%s.tmp' % (filename, getpid())
+    if isinstance(data, numpy.ndarray):
+        with open(tmp_filename, 'wb') as f:
+            numpy.save(f, data)
+    elif isinstance(data, dict):
+        with open(tmp_filename, 'wb') as f:
+            numpy.savez(f, **data)
+    else:
+        with open(tmp_filename, 'w') as f:
+            f.write(data)
+    replace(tmp_filename, filename)
+
+
+class Writer:
+    """
+    Collects writes of files and performs them in a batch on flush, or
+    continuously from a background thread. The data has to be final when it
+    is submitted (strings are, the practice arrays are not modified after
+    the simulation), a later write of the same file replaces the pending one.
+    """
+
+    def __init__(self, background=False):
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._queue = None
+        self._thread = None
+        self._error = None
+        if background:
+            self._queue = queue.Queue()
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+
+    def write(self, filename, data):
+        with self._lock:
+            new = filename not in self._pending
+            self._pending[filename] = data
+        if self._queue is not None and new:
+            self._queue.put(filename)
+
+    def flush(self):
+        """
+        Write all the pending files and wait until they are written.
+        """
+        if self._queue is not None:
+            self._queue.join()
+        else:
+            while self._write_next():
+                pass
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
+
+    def close(self):
+        self.flush()
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join()
+            self._thread = None
+
+    def _write_next(self, filename=None):
+        with self._lock:
+            if filename is None:
+                if len(self._pending) == 0:
+                    return False
+                filename = next(iter(self._pending))
+            data = self._pending.pop(filename, None)
+        if data is not None:
+            atomic_write(filename, data)
+        return True
+
+    def _run(self):
+        while True:
+            filename = self._queue.get()
+            try:
+                if filename is None:
+                    return
+                self._write_next(filename)
+            except Exception as e:
+                self._error = e
+            finally:
+                self._queue.task_done()
@@ -1,5 +1,5 @@
-from .model import OptimalModel
-from .simulator import prediction_score
+from .metrics import answer_distributions, answers_per_difficulty, intersection_trends, noise_sweep, rmse_matrix
+from .recommendation import prediction_score
 from collections import defaultdict
 import numpy
 import matplotlib.pyplot as plt
@@ -34,36 +34,27 @@ def plot_scenario(scenario):
 
 
 def plot_number_of_answers_distribution(scenario, simulators, bins=20):
-    names = []
-    numbers = []
-    for simulator_name, simulator in sorted(simulators.items()):
-        nums = list(simulator.number_of_answers().values())
-        numbers.append(nums)
-        names.append(simulator_name)
-        plt.plot(sorted(nums, reverse=True), label=simulator_name, lw='4')
+    for simulator_name, nums in sorted(answer_distributions(simulators).items()):
+        plt.plot(nums, label=simulator_name, lw='4')
     plt.xlabel('Item (sorted according to the number of answers)')
     plt.ylabel('Number of answers')
     plt.legend(loc='upper right')
 
 
 def plot_number_of_answers_per_difficulty(scenario, simulators, bins=10):
-    names = []
-    probs = []
-    for simulator_name, simulator in sorted(simulators.items()):
-        practice = [x[3] for x in [x for xs in list(simulator.get_practice().values()) for x in xs]]
-        probs.append(practice)
-        names.append(simulator_name)
+    edges, simulators_counts = answers_per_difficulty(simulators, bins=bins)
+    names, counts = list(zip(*sorted(simulators_counts.items())))
     subplot = plt.subplot(111)
     subplot.set_xlabel('True Probability of Correct Answer')
     subplot.set_ylabel('Number of Answers')
-    subplot.hist(probs, label=names, bins=bins)
+    subplot.hist([edges[:-1]] * len(counts), label=names, bins=edges, weights=counts)
     subplot_twin = subplot.twinx()
     subplot_twin.xaxis.grid(False)
     subplot_twin.yaxis.grid(False)
     xs = numpy.linspace(0, 1, 100)
     subplot_twin.plot(
         xs,
-        [prediction_score(x, scenario.target_probability()) for x in xs],
+        prediction_score(xs, scenario.target_probability()),
         '--',
         lw=3,
         color='gray',
@@ -74,15 +65,7 @@ def plot_number_of_answers_per_difficulty(scenario, simulators, bins=10):
 
 
 def plot_noise_vs_intersection_number_of_answers(scenario, optimal_simulator, destination, std_step=0.01, std_max=0.35):
-    stds = []
-    rmses = []
-    intersection = []
-    for std in numpy.arange(0, std_max, std_step):
-        model = OptimalModel(scenario.skills(), scenario.difficulties(), scenario.clusters(), noise=std)
-        simulator = scenario.init_simulator(destination, model)
-        stds.append(std)
-        rmses.append(simulator.rmse())
-        intersection.append(simulator.intersection()[0])
+    stds, rmses, intersection = noise_sweep(scenario, destination, std_step=std_step, std_max=std_max)
 
     plt.plot(stds, intersection, '-o', color=COLORS[2], label="Size of the intersection\nwith the optimal practiced set", lw=3)
     plt.xlabel('Noise (standard deviation)')
@@ -96,37 +79,28 @@ def plot_noise_vs_intersection_number_of_answers(scenario, optimal_simulator, de
     subplot_twin.legend(loc="lower center")
 
 
-def plot_intersection(scenario, simulators):
-    intersection_trends = scenario.read('plot_intersection__trends')
-    if intersection_trends is None:
-        intersection_trends = []
-        for simulator_name, simulator in simulators.items():
-            if simulator_name == 'Optimal':
-                continue
-            intersection = []
-            for i in range(1, scenario.practice_length() + 1):
-                intersection.append(simulator.intersection(i)[0])
-            intersection_trends.append(intersection)
-            print(simulator_name, intersection[-1])
-        scenario.write('plot_intersection__trends', intersection_trends)
-
-    for i, (simulator_name, _) in enumerate([n_s for n_s in list(simulators.items()) if n_s[0] != 'Optimal']):
-        plt.plot(list(range(scenario.practice_length())), intersection_trends[i], label=simulator_name, linewidth=2)
+def plot_intersection(scenario, simulators, bands=None):
+    for simulator_name, trend in intersection_trends(scenario, simulators).items():
+        lines = plt.plot(list(range(scenario.practice_length())), trend, label=simulator_name, linewidth=2)
+        if bands is not None and simulator_name in bands:
+            band = bands[simulator_name]
+            plt.fill_between(list(range(scenario.practice_length())), band['lower'], band['upper'], color=lines[0].get_color(), alpha=0.2, linewidth=0)
     plt.ylabel('Size of the Intersection')
     plt.xlabel('Number of Attempts')
     plt.legend(loc='center left', bbox_to_anchor=(1, 0.5))
 
 
-def plot_rmse_complex(scenario, simulators):
-    simulators_rmse = {}
-    for simulator_name, simulator in simulators.items():
-        current_rmse = {}
-        for data_name, data_provider in simulators.items():
-            current_rmse[data_name] = data_provider.replay(simulator._model)
-        simulators_rmse[simulator_name] = current_rmse
-    scenario.write('plot_rmse_complex__rmse', simulators_rmse)
+def plot_rmse_complex(scenario, simulators, bands=None):
+    simulators_rmse = rmse_matrix(scenario, simulators)
     to_plot = pandas.DataFrame([{'Model': s, 'Data set': d, 'RMSE': rmse} for (s, s_data) in simulators_rmse.items() for d, rmse in s_data.items()]).sort_values(by=['Model', 'Data set'])
-    sns.barplot(x='Data set', y='RMSE', hue='Model', data=to_plot)
+    models, data_sets = sorted(simulators_rmse.keys()), sorted(to_plot['Data set'].unique())
+    subplot = sns.barplot(x='Data set', y='RMSE', hue='Model', data=to_plot, order=data_sets, hue_order=models)
+    if bands is not None:
+        # one container of bars (one per data set) for each model
+        for model, bars in zip(models, subplot.containers):
+            for data_set, bar in zip(data_sets, bars):
+                band = bands[model][data_set]
+                subplot.vlines(bar.get_x() + bar.get_width() / 2, band['lower'], band['upper'], color='black', linewidth=1.5)
     plt.ylabel('RMSE')
     plt.ylim(0.4, 0.6)
     plt.legend(loc='upper center', ncol=2)
@@ -0,0 +1,239 @@
+from bisect import bisect_left
+import math
+import numpy
+
+
+PRACTICE_DTYPE = numpy.dtype([
+    ('user', numpy.int64),
+    ('item', numpy.int64),
+    ('prediction', numpy.float64),
+    ('correct', numpy.bool_),
+    ('real_prediction', numpy.float64),
+])
+
+
+def practice_to_array(practice):
+    """
+    Convert practice in the form {user: [(item, prediction, correct, real_prediction), ...]}
+    to a structured array with one row per attempt ordered by users.
+    """
+    users = sorted(practice.keys())
+    result = numpy.zeros(sum([len(practice[u]) for u in users]), dtype=PRACTICE_DTYPE)
+    result['user'] = numpy.repeat(users, [len(practice[u]) for u in users])
+    if len(result) == 0:
+        return result
+    items, predictions, corrects, real_predictions = list(zip(*[x for u in users for x in practice[u]]))
+    result['item'] = items
+    result['prediction'] = predictions
+    result['correct'] = corrects
+    result['real_prediction'] = real_predictions
+    return result
+
+
+class PracticeLog:
+    """
+    Practice of all the users stored in preallocated columns (see
+    PRACTICE_DTYPE). Attempts of each user are stored contiguously and in
+    the order in which they were made, the users are stored in the
+    increasing order. The offsets of the users in a wrapped array are
+    computed on their first use (see _index_users), so restricting it to a
+    range of users does not read the whole array.
+    """
+
+    def __init__(self, capacity=0):
+        self._data = numpy.zeros(capacity, dtype=PRACTICE_DTYPE)
+        self._size = 0
+        self._users = numpy.zeros(0, dtype=numpy.int64)
+        self._starts = numpy.zeros(0, dtype=numpy.int64)
+        self._number_of_users = 0
+
+    @staticmethod
+    def from_array(array):
+        """
+        Wrap the structured array (rows grouped by users) without copying it.
+        """
+        result = PracticeLog()
+        result._data = array
+        result._size = len(array)
+        result._number_of_users = None
+        return result
+
+    @staticmethod
+    def from_dict(practice):
+        return PracticeLog.from_array(practice_to_array(practice))
+
+    def reserve(self, capacity):
+        if capacity > len(self._data):
+            data = numpy.zeros(capacity, dtype=PRACTICE_DTYPE)
+            data[:self._size] = self._data[:self._size]
+            self._data = data
+
+    def append(self, user, item, prediction, correct, real_prediction):
+        if self._number_of_users is None:
+            self._index_users()
+        if self._number_of_users == 0 or self._users[self._number_of_users - 1] != user:
+            self._add_users(numpy.array([user], dtype=numpy.int64), self._size)
+        if self._size == len(self._data):
+            self.reserve(max(16, 2 * len(self._data)))
+        self._data[self._size] = (user, item, prediction, correct, real_prediction)
+        self._size += 1
+
+    def extend(self, users, items, predictions, corrects, real_predictions):
+        """
+        Append attempts given as columns, the attempts of each user have to
+        be contiguous.
+        """
+        users = numpy.asarray(users, dtype=numpy.int64)
+        if len(users) == 0:
+            return
+        self._index_users()
+        self.reserve(max(self._size + len(users), 2 * len(self._data)))
+        self._add_users(users, self._size)
+        data = self._data[self._size:self._size + len(users)]
+        data['user'] = users
+        data['item'] = items
+        data['prediction'] = predictions
+        data['correct'] = corrects
+        data['real_prediction'] = real_predictions
+        self._size += len(users)
+
+    def users(self):
+        users, _ = self._index_users()
+        return users.tolist()
+
+    def column(self, name, practice_length=None):
+        """
+        Return the given column for all the attempts, or only for the first
+        practice_length attempts of each user.
+        """
+        return self.to_array(practice_length)[name]
+
+    def user(self, user, practice_length=None):
+        """
+        Return the attempts of the given user as a view to the structured array.
+        """
+        users, starts = self._index_users()
+        position = numpy.searchsorted(users, user)
+        if position == len(users) or users[position] != user:
+            raise KeyError(user)
+        start = starts[position]
+        stop = starts[position + 1] if position + 1 < len(starts) else self._size
+        if practice_length is not None:
+            stop = min(stop, start + practice_length)
+        return self._data[start:stop]
+
+    def user_range(self, first, stop):
+        """
+        Return the log (sharing the data) restricted to the users
+        first..stop-1. The rows are found by bisecting the user column, so
+        only the rows of the range are read from a memory mapped array.
+        """
+        column = self._data['user'][:self._size]
+        return PracticeLog.from_array(self._data[bisect_left(column, first):bisect_left(column, stop)])
+
+    def positions(self):
+        """
+        Return the order of each attempt within the practice of its user.
+        """
+        _, starts = self._index_users()
+        lengths = numpy.diff(numpy.append(starts, self._size))
+        return numpy.arange(self._size) - numpy.repeat(starts, lengths)
+
+    def to_array(self, practice_length=None):
+        data = self._data[:self._size]
+        if practice_length is None:
+            return data
+        return data[self.positions() < practice_length]
+
+    def rmse(self, practice_length=None):
+        data = self.to_array(practice_length)
+        return math.sqrt(numpy.mean((data['prediction'] - data['correct']) ** 2))
+
+    def counts(self, number_of_items, practice_length=None):
+        """
+        Return the number of answers for each item.
+        """
+        return numpy.bincount(self.column('item', practice_length), minlength=number_of_items)
+
+    def items_matrix(self, users, practice_length, fill_value):
+        """
+        Return users x practice_length matrix of the practiced items, the
+        missing attempts are filled by the given value.
+        """
+        result = numpy.full((len(users), practice_length), fill_value, dtype=numpy.int64)
+        stored = self._index_users()[0]
+        users = numpy.asarray(users, dtype=numpy.int64)
+        if len(stored) == 0 or len(users) == 0:
+            return result
+        # rows of the users indexed from the lowest user id
+        low = min(stored[0], users.min())
+        rows = numpy.full(max(stored[-1], users.max()) - low + 1, -1, dtype=numpy.int64)
+        rows[users - low] = numpy.arange(len(users))
+        positions = self.positions()
+        data = self._data[:self._size]
+        data_rows = rows[data['user'] - low]
+        mask = (positions < practice_length) & (data_rows >= 0)
+        result[data_rows[mask], positions[mask]] = data['item'][mask]
+        return result
+
+    def items_bitset(self, users, number_of_items, practice_length):
+        """
+        Return users x ceil(number_of_items / 8) matrix of bits packed as by
+        numpy.packbits, the bit of an item is set if the user practiced it
+        within the first practice_length attempts.
+        """
+        result = numpy.zeros((len(users), (number_of_items + 7) // 8), dtype=numpy.uint8)
+        matrix = self.items_matrix(users, practice_length, -1)
+        rows, columns = numpy.nonzero(matrix >= 0)
+        items = matrix[rows, columns]
+        numpy.bitwise_or.at(result, (rows, items >> 3), (128 >> (items & 7)).astype(numpy.uint8))
+        return result
+
+    def _index_users(self, block_size=10 ** 6):
+        """
+        Return the stored users and the offsets of their attempts. For a
+        wrapped array they are computed on the first call, a block of rows
+        at a time.
+        """
+        if self._number_of_users is None:
+            self._number_of_users = 0
+            for start in range(0, self._size, block_size):
+                self._add_users(self._data['user'][start:min(start + block_size, self._size)], start)
+        return self._users[:self._number_of_users], self._starts[:self._number_of_users]
+
+    def _add_users(self, users, offset):
+        """
+        Register the users starting in the given column of contiguous user
+        ids placed at the given offset of the data.
+        """
+        if len(users) == 0:
+            return
+        starts = numpy.concatenate([[0], numpy.flatnonzero(numpy.diff(users)) + 1])
+        if self._number_of_users > 0 and self._users[self._number_of_users - 1] == users[0]:
+            starts = starts[1:]
+        size = self._number_of_users + len(starts)
+        if size > len(self._users):
+            capacity = max(size, 2 * len(self._users))
+            self._users = numpy.resize(self._users, capacity)
+            self._starts = numpy.resize(self._starts, capacity)
+        self._users[self._number_of_users:size] = users[starts]
+        self._starts[self._number_of_users:size] = starts + offset
+        self._number_of_users = size
+
+    def __getitem__(self, user):
+        return self.user(user)
+
+    def __len__(self):
+        return self._size
+
+
+def open_practice(filename, size):
+    """
+    Create a practice file for the given number of attempts and return it
+    as a writable memory mapped structured array.
+    """
+    return numpy.lib.format.open_memmap(filename, mode='w+', dtype=PRACTICE_DTYPE, shape=(size,))
+
+
+def load_practice(filename):
+    return PracticeLog.from_array(numpy.load(filename, mmap_mode='r'))
@@ -0,0 +1,179 @@
+from contextlib import contextmanager
+from os import path, makedirs
+import cProfile
+import functools
+import json
+import time
+import tracemalloc
+
+
+_STATE = {
+    'enabled': False,
+    'capture': None,
+    'capture_mode': None,
+    'directory': None,
+    'depth': {},
+}
+_PHASES = {}
+_COUNTERS = {}
+
+
+def enable(directory=None, capture=None, capture_mode='cprofile'):
+    """
+    Turn on the instrumentation of the simulation, replay, metrics and
+    cache I/O phases and counting of model calls. If the capture phase is
+    given, its (outermost) runs are profiled by cProfile or traced by
+    tracemalloc and the results are written to the directory.
+
+    The instrumentation patches the classes in place, so it has no cost
+    when it is not enabled. Calls made in worker processes are not counted.
+    """
+    if _STATE['enabled']:
+        return
+    from .model import Model
+    from .scenario import Scenario
+    from .simulator import Simulator
+    _STATE['enabled'] = True
+    _STATE['directory'] = directory
+    _STATE['capture'] = capture
+    _STATE['capture_mode'] = capture_mode
+    instrument(Scenario, 'init_simulator')
+    instrument(Scenario, 'simulate')
+    instrument(Scenario, 'save')
+    instrument(Scenario, 'load')
+    instrument(Simulator, 'simulate', hit=lambda self, checkpoint_every=None: len(self._practice) > 0)
+    instrument(Simulator, 'simulate_streaming')
+    instrument(Simulator, 'replay', hit=lambda self, model, warm_start=None: self._replay_key(model, warm_start) in self._replay)
+    instrument(Simulator, 'replay_many')
+    instrument(Simulator, 'rmse', hit=lambda self, practice_length=None: (practice_length or self._practice_length) in self._rmse)
+    instrument(Simulator, 'intersection', hit=lambda self, practice_length=None: (practice_length or self._practice_length) in self._intersection)
+    instrument(Simulator, 'intersection_curve')
+    instrument(Simulator, 'jaccard')
+    instrument(Simulator, 'jaccard_curve')
+    instrument(Simulator, 'number_of_answers', hit=lambda self: self._number_of_answers is not None)
+    instrument(Simulator, 'save')
+    instrument(Simulator, 'load')
+    instrument(Simulator, '_load_practice', hit=lambda self: len(self._practice) > 0)
+    instrument(Simulator, '_save_practice')
+    instrument(Simulator, '_load_stats', hit=lambda self: self._stats_loaded)
+    instrument(Simulator, '_save_stats')
+    for model_class in [Model] + _subclasses(Model):
+        for method in ['predict', 'predict_many', 'predict_matrix', 'update']:
+            if method in model_class.__dict__:
+                _count_calls(model_class, method)
+
+
+def enabled():
+    return _STATE['enabled']
+
+
+def instrument(owner, name, phase_name=None, hit=None):
+    """
+    Replace the method of the given class by a wrapper measuring it as
+    a phase. The optional hit function gets the arguments of the call and
+    tells whether the call is served from the cache.
+    """
+    if phase_name is None:
+        phase_name = '%s.%s' % (owner.__name__, name)
+    original = getattr(owner, name)
+
+    @functools.wraps(original)
+    def _wrapper(*args, **kwargs):
+        with phase(phase_name, hit=None if hit is None else hit(*args, **kwargs)):
+            return original(*args, **kwargs)
+    setattr(owner, name, _wrapper)
+
+
+@contextmanager
+def phase(name, hit=None):
+    """
+    Measure wall and CPU time of the block as the given phase, nested
+    calls of the same phase are accounted to the outermost one.
+    """
+    if not _STATE['enabled']:
+        yield
+        return
+    stats = _PHASES.setdefault(name, {'calls': 0, 'wall': 0.0, 'cpu': 0.0, 'hits': 0, 'misses': 0})
+    stats['calls'] += 1
+    if hit is not None:
+        stats['hits' if hit else 'misses'] += 1
+    depth = _STATE['depth'].get(name, 0)
+    _STATE['depth'][name] = depth + 1
+    capture = depth == 0 and name == _STATE['capture']
+    profiler = None
+    if capture and _STATE['capture_mode'] == 'cprofile':
+        profiler = cProfile.Profile()
+        profiler.enable()
+    elif capture and _STATE['capture_mode'] == 'tracemalloc':
+        tracemalloc.start(25)
+    wall, cpu = time.perf_counter(), time.process_time()
+    try:
+        yield
+    finally:
+        _STATE['depth'][name] = depth
+        if depth == 0:
+            stats['wall'] += time.perf_counter() - wall
+            stats['cpu'] += time.process_time() - cpu
+        if profiler is not None:
+            profiler.disable()
+            profiler.dump_stats(_capture_filename(name, 'prof'))
+        elif capture and _STATE['capture_mode'] == 'tracemalloc':
+            snapshot = tracemalloc.take_snapshot()
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            with open(_capture_filename(name, 'txt'), 'a') as f:
+                f.write('peak: %s B\n' % peak)
+                for stat in snapshot.statistics('lineno')[:50]:
+                    f.write('%s\n' % stat)
+                f.write('\n')
+
+
+def report():
+    return {
+        'phases': dict([(name, dict(stats)) for name, stats in _PHASES.items()]),
+        'counters': dict(_COUNTERS),
+    }
+
+
+def save_report(filename):
+    directory = path.dirname(filename)
+    if directory and not path.exists(directory):
+        makedirs(directory)
+    with open(filename, 'w') as f:
+        json.dump(report(), f, indent=2, sort_keys=True)
+
+
+def format_report():
+    lines = ['%-46s %8s %10s %10s %6s %6s' % ('phase', 'calls', 'wall [s]', 'cpu [s]', 'hits', 'misses')]
+    for name, stats in sorted(_PHASES.items(), key=lambda n_s: -n_s[1]['wall']):
+        lines.append('%-46s %8d %10.3f %10.3f %6d %6d' % (
+            name, stats['calls'], stats['wall'], stats['cpu'], stats['hits'], stats['misses']))
+    for name, value in sorted(_COUNTERS.items()):
+        lines.append('%-46s %8d' % (name, value))
+    return '\n'.join(lines)
+
+
+def _capture_filename(name, extension):
+    directory = _STATE['directory'] or '.'
+    if not path.exists(directory):
+        makedirs(directory)
+    return '%s/profile_%s.%s' % (directory, name, extension)
+
+
+def _count_calls(owner, name):
+    original = owner.__dict__[name]
+    counter = '%s.%s' % (owner.__name__, name)
+
+    @functools.wraps(original)
+    def _wrapper(self, *args, **kwargs):
+        _COUNTERS[counter] = _COUNTERS.get(counter, 0) + 1
+        return original(self, *args, **kwargs)
+    setattr(owner, name, _wrapper)
+
+
+def _subclasses(cls):
+    result = []
+    for subclass in cls.__subclasses__():
+        result.append(subclass)
+        result += _subclasses(subclass)
+    return result
@@ -0,0 +1,173 @@
+from bisect import bisect_left, bisect_right, insort
+from collections import defaultdict
+import numpy
+
+
+# below this pool size scoring all the items at once is faster than the
+# binary search over the sorted index
+INDEX_MIN_ITEMS = 2000
+
+
+def prediction_score(probability, target_probability):
+    diff = target_probability - numpy.asarray(probability)
+    sign = numpy.where(diff > 0, 1, -1)
+    normed_diff = numpy.abs(diff) / numpy.maximum(0.001, numpy.abs(target_probability - 0.5 + sign * 0.5))
+    return 1 - normed_diff ** 2
+
+
+def _best(scores, priorities):
+    best = numpy.flatnonzero(scores == scores.max())
+    return int(best[numpy.argmax(priorities[best])])
+
+
+def recommendation(model, items, target_probability):
+    """
+    Create the fastest recommendation engine available for the given model.
+    """
+    if len(items) >= INDEX_MIN_ITEMS and model.monotone_items() is not None:
+        return IndexedRecommendation(model, items, target_probability)
+    return ScoredRecommendation(model, items, target_probability)
+
+
+class ScoredRecommendation:
+    """
+    Scores all the items not practiced by the current user at once and picks
+    the best one. Works with any model.
+    """
+
+    def __init__(self, model, items, target_probability):
+        self._model = model
+        self._items = numpy.array(sorted(items), dtype=numpy.int64)
+        self._positions = dict((item, position) for position, item in enumerate(self._items.tolist()))
+        self._target_probability = target_probability
+        self._practiced = numpy.zeros(len(self._items), dtype=bool)
+        self._priorities = None
+
+    def start(self, user, random_generator):
+        """
+        Start the practice of the given user, the random generator is used
+        to draw priorities (one per item) breaking the ties.
+        """
+        self._practiced.fill(False)
+        self._priorities = random_generator.random(len(self._items))
+
+    def recommend(self, user):
+        predictions = self._model.predict_many(user, self._items)
+        scores = prediction_score(predictions, self._target_probability)
+        scores[self._practiced] = -numpy.inf
+        position = _best(scores, self._priorities)
+        return int(self._items[position]), float(predictions[position])
+
+    def update(self, user, item, correct):
+        self._model.update(user, item, correct)
+        self._practiced[self._positions[item]] = True
+
+
+class IndexedRecommendation:
+    """
+    Recommendation for models whose prediction is non-increasing in the item
+    difficulty within each cluster (see Model.monotone_items). Items are kept
+    in per-cluster lists sorted by the current difficulty, so the best item
+    is found by a binary search instead of scoring the whole pool.
+    """
+
+    def __init__(self, model, items, target_probability):
+        self._model = model
+        self._target_probability = target_probability
+        clusters, difficulties = model.monotone_items()
+        self._keys = {}
+        self._clusters = {}
+        self._index = defaultdict(list)
+        for item in items:
+            key = (float(difficulties[item]), item)
+            self._keys[item] = key
+            self._clusters[item] = int(clusters[item])
+            self._index[self._clusters[item]].append(key)
+        for keys in self._index.values():
+            keys.sort()
+        self._practiced = set()
+        self._random_generator = None
+
+    def start(self, user, random_generator):
+        self._practiced = set()
+        self._random_generator = random_generator
+
+    def recommend(self, user):
+        best_score = None
+        candidates = []
+        for cluster, keys in self._index.items():
+            position = self._split(user, keys)
+            for neighbour in [self._unpracticed(keys, position - 1, -1), self._unpracticed(keys, position, 1)]:
+                if neighbour is None:
+                    continue
+                prediction = self._model.predict(user, keys[neighbour][1])
+                score = float(prediction_score(prediction, self._target_probability))
+                if best_score is None or score > best_score:
+                    best_score = score
+                    candidates = []
+                if score == best_score:
+                    candidates.append((cluster, keys[neighbour][0], prediction))
+        return self._choose(candidates)
+
+    def update(self, user, item, correct):
+        self._model.update(user, item, correct)
+        self._practiced.add(item)
+        _, difficulties = self._model.monotone_items()
+        key = (float(difficulties[item]), item)
+        if key != self._keys[item]:
+            keys = self._index[self._clusters[item]]
+            del keys[bisect_left(keys, self._keys[item])]
+            insort(keys, key)
+            self._keys[item] = key
+
+    def _split(self, user, keys):
+        """
+        Return the first position whose item is predicted below the target
+        probability.
+        """
+        lower, upper = 0, len(keys)
+        while lower < upper:
+            middle = (lower + upper) // 2
+            if self._model.predict(user, keys[middle][1]) >= self._target_probability:
+                lower = middle + 1
+            else:
+                upper = middle
+        return lower
+
+    def _unpracticed(self, keys, position, step):
+        while 0 <= position < len(keys):
+            if keys[position][1] not in self._practiced:
+                return position
+            position += step
+        return None
+
+    def _choose(self, candidates):
+        """
+        Pick uniformly at random one of the unpracticed items sharing the
+        cluster and difficulty with one of the equally scored candidates.
+        """
+        runs = []
+        for cluster, difficulty, prediction in candidates:
+            keys = self._index[cluster]
+            lower = bisect_left(keys, (difficulty, ))
+            upper = bisect_right(keys, (difficulty, float('inf')))
+            practiced = [
+                i for i in self._practiced
+                if self._clusters[i] == cluster and self._keys[i][0] == difficulty
+            ]
+            runs.append((keys, lower, upper, practiced, prediction))
+        chosen = self._random_generator.integers(sum([upper - lower - len(practiced) for _, lower, upper, practiced, _ in runs]))
+        chosen = int(chosen)
+        for keys, lower, upper, practiced, prediction in runs:
+            size = upper - lower - len(practiced)
+            if chosen >= size:
+                chosen -= size
+                continue
+            if len(practiced) == 0:
+                return keys[lower + chosen][1], prediction
+            if 2 * len(practiced) > upper - lower:
+                return [k[1] for k in keys[lower:upper] if k[1] not in self._practiced][chosen], prediction
+            while True:
+                item = keys[self._random_generator.integers(lower, upper)][1]
+                if item not in self._practiced:
+                    return item, prediction
@@ -0,0 +1,58 @@
+import numpy
+
+
+def bootstrap_weights(random_generator, size, resamples):
+    """
+    Return resamples x size matrix with the number of times each of the
+    size elements is drawn into the resample (drawing with replacement).
+    """
+    return random_generator.multinomial(size, numpy.full(size, 1.0 / size), size=resamples).astype(numpy.float64)
+
+
+def bootstrap(values, weights=None, resamples=1000, confidence=0.95, random_generator=None, chunk_size=100):
+    """
+    Take replicas x users (x ...) array of per-user values and return the
+    estimate of their mean together with the lower and upper bound of its
+    confidence interval (arrays of the shape of the trailing axes). The
+    replicas and the users are both resampled with replacement. If the
+    weights (of the shape of the values, e.g. the numbers of attempts of
+    the users while the values are their sums of squared errors) are given,
+    the ratio of the sum of the values to the sum of the weights is
+    estimated instead of the mean.
+
+    A resample is represented by the numbers of draws of each replica and
+    each user, so the statistics of a chunk of resamples are computed by
+    a single matrix product over all the users.
+    """
+    values = numpy.asarray(values, dtype=numpy.float64)
+    shape = values.shape[2:]
+    replicas, users = values.shape[:2]
+    values = values.reshape(replicas, users, -1)
+    if weights is not None:
+        weights = numpy.broadcast_to(numpy.asarray(weights, dtype=numpy.float64).reshape(replicas, users, -1), values.shape)
+    if random_generator is None:
+        random_generator = numpy.random.default_rng()
+    replica_weights = bootstrap_weights(random_generator, replicas, resamples)
+    user_weights = bootstrap_weights(random_generator, users, resamples)
+    # users x (replicas * values), contiguous for the matrix products
+    by_user = numpy.ascontiguousarray(values.transpose(1, 0, 2).reshape(users, -1))
+    by_user_weights = None if weights is None else numpy.ascontiguousarray(weights.transpose(1, 0, 2).reshape(users, -1))
+    statistics = numpy.empty((resamples, values.shape[2]))
+    for start in range(0, resamples, chunk_size):
+        stop = min(start + chunk_size, resamples)
+        sums = _resampled_sums(by_user, replica_weights[start:stop], user_weights[start:stop])
+        if by_user_weights is None:
+            statistics[start:stop] = sums / (replicas * users)
+        else:
+            statistics[start:stop] = sums / _resampled_sums(by_user_weights, replica_weights[start:stop], user_weights[start:stop])
+    if weights is None:
+        estimate = values.mean(axis=(0, 1))
+    else:
+        estimate = values.sum(axis=(0, 1)) / weights.sum(axis=(0, 1))
+    lower, upper = numpy.percentile(statistics, [50 * (1 - confidence), 50 * (1 + confidence)], axis=0)
+    return estimate.reshape(shape), lower.reshape(shape), upper.reshape(shape)
+
+
+def _resampled_sums(by_user, replica_weights, user_weights):
+    resampled = (user_weights @ by_user).reshape(len(user_weights), replica_weights.shape[1], -1)
+    return numpy.einsum('br,brk->bk', replica_weights, resampled)
@@ -2,21 +2,47 @@ import json
 import hashlib
 from os import path
 import numpy
-import random
-from .util import convert_dict
+from .util import ArrayDict, convert_dict, dict_to_array
 from .model import OptimalModel
-from .simulator import Simulator
+from .simulator import Simulator, similarity_stats
+from .parallel import simulate_all
+from .persistence import Writer, atomic_write
 
 
-def load_scenario(json_file, name, version):
+ARRAY_DTYPES = {
+    'skills': numpy.float64,
+    'difficulties': numpy.float64,
+    'clusters': numpy.int64,
+}
+
+
+def load_scenario(json_file, name, version, common_random_numbers=False):
+    return load_scenarios(json_file, [name], version, common_random_numbers=common_random_numbers)[0]
+
+
+def load_scenarios(json_file, names, version, common_random_numbers=False):
+    """
+    Load the scenarios with the given names (in the given order), or all
+    the scenarios if the names contain 'all', parsing the settings once.
+    """
     with open(json_file, 'r') as f:
         scenarios = json.loads(f.read())['scenarios']
-        return Scenario(list(filter(lambda s: s['name'] == name, scenarios))[0], version=version)
+    if 'all' in names:
+        return [Scenario(config, version=version, common_random_numbers=common_random_numbers) for config in scenarios]
+    by_name = dict([(config['name'], config) for config in scenarios])
+    for name in names:
+        if name not in by_name:
+            raise ValueError("There is no scenario '%s' in %s." % (name, json_file))
+    return [Scenario(by_name[name], version=version, common_random_numbers=common_random_numbers) for name in names]
+
+
+def _spawn_key(key):
+    return [k if isinstance(k, int) else int(hashlib.sha1(str(k).encode()).hexdigest(), 16) for k in key]
 
 
 class Scenario:
 
-    def __init__(self, config, version=None):
+    def __init__(self, config, version=None, common_random_numbers=False):
         self._data = {'config': config}
         self._data['config']['version'] = None
         self._data['storage'] = {}
@@ -25,34 +51,188 @@ class Scenario:
         self._simulators = {}
         self._optimal_simulator = None
         self._optimal_simulator_saved = False
+        self._train_simulator = None
+        # all the simulators share the random numbers, so their differences
+        # are not blurred by the simulation noise
+        self._common_random_numbers = common_random_numbers
+        # parts of the data changed since they were loaded or saved
+        self._dirty = set(['config'])
+        self._sidecar = None
 
-    def init_simulator(self, directory, model, practice_length=None, target_probability=None):
+    def init_simulator(self, directory, model, practice_length=None, target_probability=None, warm_start=None):
+        """
+        Return the simulator of the model (loaded from the directory). If the
+        warm start simulator is given, the model starts from the state it
+        learns from the practice of that simulator (see warm_start).
+        """
         if not self._optimal_simulator_saved and self._optimal_simulator is not None:
             self._optimal_simulator.load(self.filename(directory))
+        if warm_start is not None:
+            warm_start = self.warm_start(directory, model, warm_start)
         model.reset()
         simulator = Simulator(
             OptimalModel(self.skills(), self.difficulties(), self.clusters()),
             model,
             self,
             practice_length=practice_length,
-            target_probability=target_probability)
+            target_probability=target_probability,
+            warm_start=warm_start,
+            common_random_numbers=self._common_random_numbers)
         simulator_name = str(simulator)
         found_simulator = self._simulators.get(simulator_name)
         if found_simulator is None:
             simulator.load(self.filename(directory))
             self._simulators[simulator_name] = simulator
-            simulator.save(self.filename(directory))
             found_simulator = simulator
         return found_simulator
 
-    def optimal_simulator(self):
+    def simulate(self, directory, jobs=1, chunk_size=None, checkpoint_every=None, save=True):
+        """
+        Simulate all the registered simulators (including the optimal one)
+        whose practice is not cached yet, using the given number of processes.
+        If the chunk size is given, the simulators are simulated one by one in
+        the streaming mode (see Simulator.simulate_streaming). If the
+        checkpoint interval (number of users) is given, the simulations save
+        checkpoints to the cache directory and resume from them. Unless save
+        is False, the practice is saved to the cache as soon as it is
+        computed (the streaming mode always writes it to the cache).
+        """
+        if chunk_size is not None:
+            simulators = list(self._simulators.values()) + [self.optimal_simulator()]
+            for simulator in reversed(simulators):
+                simulator.simulate_streaming(self.filename(directory), chunk_size=chunk_size, checkpoint=checkpoint_every is not None)
+            return
+        if not save:
+            simulate_all(self, self.pending_simulators(directory), jobs, checkpoint_every=checkpoint_every)
+            return
+        # the practice is written in the background as soon as it is computed
+        writer = Writer(background=True)
+        try:
+            simulate_all(
+                self, self.pending_simulators(directory), jobs,
+                progress=lambda scenario, simulator, done, total, seconds: simulator.save(self.filename(directory), writer),
+                checkpoint_every=checkpoint_every)
+        finally:
+            writer.close()
+
+    def pending_simulators(self, directory):
+        """
+        Return the registered simulators (including the optimal one) whose
+        practice is not cached yet.
+        """
+        to_simulate = []
+        for simulator in list(self._simulators.values()) + [self.optimal_simulator()]:
+            simulator.load(self.filename(directory))
+            if not simulator.has_practice():
+                to_simulate.append(simulator)
+        return to_simulate
+
+    def warm_start(self, directory, model, data):
+        """
+        Return (key, snapshot) of the state of the items the model learns
+        from the practice of the given simulator, which has to practice the
+        test items (see train_simulator). The snapshots are cached in the
+        directory of the scenario, keyed by the model and the simulator.
+        """
+        if not numpy.array_equal(dict_to_array(data.items(), numpy.float64), dict_to_array(self.difficulties(), numpy.float64)):
+            raise ValueError('The warm start has to be fitted on the practice of the test items.')
+        key = hashlib.sha1(('%s|%s' % (model, data.hash())).encode()).hexdigest()
+        filename = '%s/warm_start_%s.npz' % (self.filename(directory), key)
+        if path.exists(filename):
+            with numpy.load(filename) as f:
+                return key, dict([(name, f[name]) for name in f.files])
+        data.load(self.filename(directory))
+        snapshot = data.fit(model)
+        data.save(self.filename(directory))
+        atomic_write(filename, snapshot)
+        return key, snapshot
+
+    def train_simulator(self):
+        """
+        Return the simulator of the optimal model on the train users
+        practicing the test items, e.g. to warm start the models from (see
+        warm_start).
+        """
+        if self._train_simulator is None:
+            optimal_model = OptimalModel(self.train_skills(), self.difficulties(), self.clusters())
+            self._train_simulator = Simulator(optimal_model, optimal_model, self, train='users', common_random_numbers=self._common_random_numbers)
+        return self._train_simulator
+
+    def similarity_matrix(self, practice_length=None, simulators=None):
+        """
+        Compare the practiced sets of all the pairs of the given simulators
+        (by default the optimal and all the registered ones) and return
+        their names and means and standard deviations (over users) of the
+        size of the intersection and of the Jaccard index as matrices.
+        """
+        if practice_length is None:
+            practice_length = self.practice_length()
+        if simulators is None:
+            simulators = [self.optimal_simulator()] + list(self._simulators.values())
+        users = list(range(self.number_of_users()))
+        bitsets = [s.get_practice().items_bitset(users, self.number_of_items(), practice_length) for s in simulators]
+        intersection_mean, intersection_std, jaccard_mean, jaccard_std = similarity_stats(bitsets)
+        return {
+            'simulators': [str(s) for s in simulators],
+            'intersection': {'mean': intersection_mean, 'std': intersection_std},
+            'jaccard': {'mean': jaccard_mean, 'std': jaccard_std},
+        }
+
+    def optimal_simulator(self, replica=0):
         if self._optimal_simulator is None:
             optimal_model = OptimalModel(self.skills(), self.difficulties(), self.clusters())
             self._optimal_simulator = Simulator(
                 optimal_model,
                 optimal_model,
-                self)
-        return self._optimal_simulator
+                self,
+                common_random_numbers=self._common_random_numbers)
+        if replica == 0:
+            return self._optimal_simulator
+        simulator = self._optimal_simulator.replica(replica)
+        return self._simulators.setdefault(str(simulator), simulator)
+
+    def replicas(self, directory, simulator, number_of_replicas):
+        """
+        Return the list of the given simulator and its replicas (see
+        Simulator.replica) loaded from the directory. The replicas are
+        registered, so they are simulated by simulate and saved by save.
+        """
+        result = [simulator]
+        for replica in range(1, number_of_replicas):
+            current = simulator.replica(replica)
+            found = self._simulators.get(str(current))
+            if found is None:
+                current.load(self.filename(directory))
+                self._simulators[str(current)] = current
+                found = current
+            result.append(found)
+        return result
+
+    def seed(self):
+        """
+        Return the seed of the scenario, set in the config or derived from it.
+        """
+        if 'seed' in self._data['config']:
+            return int(self._data['config']['seed'])
+        return int(self.config_hash(), 16)
+
+    def random_generator(self, *key):
+        """
+        Return an independent random generator for the given key (strings
+        and non-negative integers) derived from the seed of the scenario.
+        """
+        return numpy.random.Generator(numpy.random.PCG64(numpy.random.SeedSequence(self.seed(), spawn_key=_spawn_key(key))))
+
+    def random_generators(self, *key):
+        """
+        Return a function taking a non-negative integer (e.g. a user) and
+        returning the random generator of the given key extended by it (see
+        random_generator). The seed and the key are derived only once, so it
+        is cheap to get the generators of many users.
+        """
+        seed = self.seed()
+        spawn_key = _spawn_key(key)
+        return lambda index: numpy.random.Generator(numpy.random.PCG64(numpy.random.SeedSequence(seed, spawn_key=spawn_key + [index])))
 
     def config_hash(self):
         return hashlib.sha1(json.dumps(self._data['config'], sort_keys=True).encode()).hexdigest()
@@ -75,42 +255,70 @@ class Scenario:
     def number_of_users(self):
         return self._data['config']['number_of_users']
 
+    def cost(self):
+        """
+        Return the estimated cost of a simulation of the scenario.
+        """
+        return self.number_of_users() * self.number_of_items() * self.practice_length()
+
     def number_of_items_with_wrong_cluster(self):
         return self._data['config']['wrong_clusters']['number_of_items']
 
     def affected_wrong_clusters(self):
         return self._data['config']['wrong_clusters']['affected_clusters']
 
+    def name(self):
+        return self._data['config']['name']
+
     def write(self, key, value):
-        self._data['storage'][key] = value
+        if self._data['storage'].get(key) != value:
+            self._data['storage'][key] = value
+            self._dirty.add('storage:' + key)
 
     def read(self, key):
         return self._data['storage'].get(key)
 
     def load(self, directory):
+        """
+        Load the scenario saved in the directory, the arrays (skills,
+        difficulties and clusters) stored in the binary sidecar are loaded
+        lazily when they are accessed for the first time.
+        """
         if not path.exists(self.filename(directory) + '.json'):
             return
         with open(self.filename(directory) + '.json', 'r') as f:
             self._data = json.loads(f.read())
-            for storage_key in ['test_set', 'train_set']:
-                storage = self._data[storage_key]
-                for key in ['difficulties']:
-                    if key in storage:
-                        storage[key] = convert_dict(storage[key], int, float)
-                for key in ['skills']:
-                    if key in storage:
-                        storage[key] = convert_dict(storage[key], int, lambda xs: list(map(float, list(xs))))
-                for key in ['clusters']:
-                    if key in storage:
-                        storage[key] = convert_dict(storage[key], int, int)
-
-    def save(self, directory):
-        with open(self.filename(directory) + '.json', 'w') as f:
-            json.dump(self._data, f)
+        self._dirty = set()
+        self._sidecar = self.filename(directory) + '.npz' if path.exists(self.filename(directory) + '.npz') else None
+        for storage_key in ['test_set', 'train_set']:
+            storage = self._data[storage_key]
+            for key in list(storage.keys()):
+                # old caches keep the arrays in the JSON, they are migrated
+                # to the sidecar on the next save
+                values = convert_dict(storage[key], int, lambda x: x)
+                storage[key] = ArrayDict(numpy.array([values[i] for i in range(len(values))], dtype=ARRAY_DTYPES[key]))
+                self._dirty.add('%s:%s' % (storage_key, key))
+
+    def save(self, directory, writer=None):
+        """
+        Save the scenario (if it changed) and the changed stats and practice
+        of its simulators. The files are written by the given writer (see
+        persistence.Writer), or in one batch before returning.
+        """
+        flush = writer is None
+        if flush:
+            writer = Writer()
+        if len(self._dirty) > 0:
+            if any([d.split(':')[0] in ['test_set', 'train_set'] for d in self._dirty]):
+                writer.write(self.filename(directory) + '.npz', self._arrays())
+            writer.write(self.filename(directory) + '.json', json.dumps(dict(self._data, test_set={}, train_set={})))
+            self._dirty = set()
         for simulator in list(self._simulators.values()):
-            simulator.save(self.filename(directory))
+            simulator.save(self.filename(directory), writer)
         if self._optimal_simulator is not None:
-            self._optimal_simulator.save(self.filename(directory))
+            self._optimal_simulator.save(self.filename(directory), writer)
+        if flush:
+            writer.flush()
 
     def skills(self):
         return self._skills(self._data['test_set'])
@@ -134,27 +342,48 @@ class Scenario:
         return directory + '/' + self._data['config']['name'] + '_' + self.config_hash()[:10]
 
     def _clusters(self, storage):
-        if 'clusters' not in storage:
-            number_of_items = self.number_of_items()
-            number_of_clusters = self.number_of_clusters()
-            storage['clusters'] = dict([(i, random.choice(list(range(number_of_clusters)))) for i in range(number_of_items)])
-        return storage['clusters']
+        return self._array(storage, 'clusters', lambda random_generator: random_generator.integers(
+            self.number_of_clusters(), size=self.number_of_items()))
 
     def _difficulties(self, storage):
-        if 'difficulties' not in storage:
-            number_of_items = int(self._data['config']['number_of_items'])
-            difficulty_mean = float(self._data['config']['difficulty']['mean'])
-            difficulty_std = float(self._data['config']['difficulty']['std'])
-            storage['difficulties'] = dict([(i, numpy.random.normal(difficulty_mean, difficulty_std)) for i in range(number_of_items)])
-        return storage['difficulties']
+        return self._array(storage, 'difficulties', lambda random_generator: random_generator.normal(
+            float(self._data['config']['difficulty']['mean']),
+            float(self._data['config']['difficulty']['std']),
+            size=int(self._data['config']['number_of_items'])))
 
     def _skills(self, storage):
-        if 'skills' not in storage:
-            number_of_users = self.number_of_users()
-            def _skill():
-                skills = []
-                for skill in self._data['config']['skills']:
-                    skills.append(numpy.random.normal(float(skill['mean']), float(skill['std'])))
-                return skills
-            storage['skills'] = dict([(u, _skill()) for u in range(number_of_users)])
-        return storage['skills']
+        means = [float(skill['mean']) for skill in self._data['config']['skills']]
+        stds = [float(skill['std']) for skill in self._data['config']['skills']]
+        return self._array(storage, 'skills', lambda random_generator: random_generator.normal(
+            means, stds, size=(self.number_of_users(), len(means))))
+
+    def _array(self, storage, key, generate):
+        """
+        Return the array of the storage as an ArrayDict, it is read from the
+        sidecar, or generated from its own random stream if it is missing.
+        """
+        if key not in storage:
+            storage_name = self._storage_name(storage)
+            array = None
+            if self._sidecar is not None:
+                with numpy.load(self._sidecar) as sidecar:
+                    if '%s__%s' % (storage_name, key) in sidecar.files:
+                        array = sidecar['%s__%s' % (storage_name, key)]
+            if array is None:
+                array = generate(self.random_generator(key, storage_name))
+                self._dirty.add('%s:%s' % (storage_name, key))
+            storage[key] = ArrayDict(numpy.asarray(array, dtype=ARRAY_DTYPES[key]))
+        return storage[key]
+
+    def _arrays(self):
+        arrays = {}
+        if self._sidecar is not None:
+            with numpy.load(self._sidecar) as sidecar:
+                arrays = dict([(name, sidecar[name]) for name in sidecar.files])
+        for storage_key in ['test_set', 'train_set']:
+            for key, values in self._data[storage_key].items():
+                arrays['%s__%s' % (storage_key, key)] = values.array
+        return arrays
+
+    def _storage_name(self, storage):
+        return 'train_set' if storage is self._data['train_set'] else 'test_set'
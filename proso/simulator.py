@@ -1,115 +1,386 @@
-from os import path, makedirs
-from .util import rmse, convert_dict
+from os import path, makedirs, remove, rename, fsync
+from .util import convert_dict
+from .model import common_uniforms
+from .recommendation import prediction_score, recommendation
+from .practice import PRACTICE_DTYPE, PracticeLog, open_practice, load_practice
+from .persistence import Writer, atomic_write
 import hashlib
 import json
+import math
 import numpy
-import random
-from functools import reduce
 
 
-def prediction_score(probability, target_probability):
-    diff = target_probability - probability
-    sign = 1 if diff > 0 else -1
-    normed_diff = abs(diff) / max(0.001, abs(target_probability - 0.5 + sign * 0.5))
-    return 1 - normed_diff ** 2
+def intersection_sizes(first, second, chunk_size=1000):
+    """
+    Take two users x practice_length matrices of practiced items (missing
+    attempts filled by -1 in the first one and by -2 in the second one) and
+    return the matrices with the size of the intersection of the practiced
+    sets and with the sizes of both the practiced sets for every prefix
+    length.
+    """
+    counts = numpy.zeros(first.shape, dtype=numpy.int64)
+    for start in range(0, len(first), chunk_size):
+        # every item practiced in both the sets enters the intersection
+        # once it is contained in both the prefixes
+        user, first_position, second_position = numpy.nonzero(
+            first[start:start + chunk_size, :, None] == second[start:start + chunk_size, None, :])
+        numpy.add.at(counts, (user + start, numpy.maximum(first_position, second_position)), 1)
+    return (
+        numpy.cumsum(counts, axis=1),
+        numpy.cumsum(first != -1, axis=1),
+        numpy.cumsum(second != -2, axis=1))
 
 
-def recommend(items_with_predictions, target_probability):
-    scored = [(prediction_score(i_p[1], target_probability), random.random(), i_p[0]) for i_p in list(items_with_predictions.items())]
-    return sorted(scored, reverse=True)[0][2]
+_POPCOUNT = numpy.array([bin(i).count('1') for i in range(256)], dtype=numpy.uint8)
 
 
-def recommend_random(items_with_predictions):
-    return random.choice(list(items_with_predictions.keys()))
+def similarity_stats(bitsets, chunk_size=1000):
+    """
+    Take a list of users x bytes matrices of packed practiced sets (see
+    PracticeLog.items_bitset) and return means and standard deviations
+    (over users) of the size of the intersection and of the Jaccard index
+    for all the pairs, as four matrices.
+    """
+    number_of_users = len(bitsets[0]) if len(bitsets) > 0 else 0
+    shape = (len(bitsets), len(bitsets))
+    sums = dict([(key, numpy.zeros(shape)) for key in ['intersection', 'intersection2', 'jaccard', 'jaccard2']])
+    for start in range(0, number_of_users, chunk_size):
+        block = numpy.stack([bitset[start:start + chunk_size] for bitset in bitsets])
+        sizes = _POPCOUNT[block].sum(axis=2, dtype=numpy.int64)
+        for i in range(len(bitsets)):
+            intersection = _POPCOUNT[block[i] & block[i:]].sum(axis=2, dtype=numpy.int64)
+            jaccard = intersection / numpy.maximum(sizes[i] + sizes[i:] - intersection, 1).astype(numpy.float64)
+            for key, values in [('intersection', intersection), ('jaccard', jaccard)]:
+                sums[key][i, i:] += values.sum(axis=1)
+                sums[key + '2'][i, i:] += (values.astype(numpy.float64) ** 2).sum(axis=1)
+    result = []
+    for key in ['intersection', 'jaccard']:
+        upper = numpy.triu(sums[key])
+        means = (upper + numpy.triu(upper, 1).T) / max(number_of_users, 1)
+        upper = numpy.triu(sums[key + '2'])
+        squares = (upper + numpy.triu(upper, 1).T) / max(number_of_users, 1)
+        result += [means, numpy.sqrt(numpy.maximum(squares - means ** 2, 0))]
+    return tuple(result)
+
+
+def replay_errors(practice, models, snapshots=None, number_of_users=None):
+    """
+    Replay the practice log to the given models (reset beforehand, or
+    restored from the given snapshots) in one pass and return the models x
+    users matrix of the sums of squared errors and the numbers of attempts
+    of the users.
+    """
+    users = practice.column('user')
+    errors = numpy.empty((len(models), len(users)))
+    for model, snapshot in zip(models, snapshots if snapshots is not None else [None] * len(models)):
+        model.reset()
+        if snapshot is not None:
+            model.restore(snapshot)
+    for j, (u, item, correct) in enumerate(zip(users.tolist(), *[practice.column(c).tolist() for c in ['item', 'correct']])):
+        for i, model in enumerate(models):
+            errors[i, j] = (model.predict(u, item) - correct) ** 2
+        for model in models:
+            model.update(u, item, correct)
+    if number_of_users is None:
+        number_of_users = int(users.max()) + 1 if len(users) > 0 else 0
+    return (
+        numpy.array([numpy.bincount(users, weights=model_errors, minlength=number_of_users) for model_errors in errors]).reshape(len(models), number_of_users),
+        numpy.bincount(users, minlength=number_of_users))
+
+
+def replay_rmse(practice, models, snapshots=None):
+    """
+    Replay the practice log to the given models (reset beforehand, or
+    restored from the given snapshots, see Model.snapshot) in one pass and
+    return the list of their RMSEs.
+    """
+    squared_errors = [0.0 for _ in models]
+    count = 0
+    for model, snapshot in zip(models, snapshots if snapshots is not None else [None] * len(models)):
+        model.reset()
+        if snapshot is not None:
+            model.restore(snapshot)
+    for u, item, correct in zip(*[practice.column(c).tolist() for c in ['user', 'item', 'correct']]):
+        for i, model in enumerate(models):
+            squared_errors[i] += (model.predict(u, item) - correct) ** 2
+            model.update(u, item, correct)
+        count += 1
+    return [math.sqrt(squared_error / count) for squared_error in squared_errors]
 
 
 class Simulator:
 
-    def __init__(self, optimal_model, model, scenario, practice_length=None, train=False, target_probability=None):
+    def __init__(self, optimal_model, model, scenario, practice_length=None, train=False, target_probability=None, warm_start=None, replica=0, common_random_numbers=False):
         if practice_length is None:
             practice_length = scenario.practice_length()
         if target_probability is None:
             target_probability = scenario.target_probability()
         self._optimal_model = optimal_model
         self._model = model
+        # train is True for the train users and items, 'users' for the train
+        # users practicing the test items
         if train:
             self._users = scenario.train_skills()
+        else:
+            self._users = scenario.skills()
+        if train and train != 'users':
             self._items = scenario.train_difficulties()
             self._clusters = scenario.train_clusters()
         else:
-            self._users = scenario.skills()
             self._items = scenario.difficulties()
             self._clusters = scenario.clusters()
         self._train = train
+        # (key, snapshot) of the state the model starts from, see Scenario.warm_start
+        self._warm_start = warm_start
+        # replicas differ only by the random stream of the simulation
+        self._replica = replica
+        # the random numbers shared by all the simulators of the scenario (the
+        # train simulators share a separate stream, so the answers of the
+        # train users never repeat the noise of the test users)
+        self._common_random_numbers = common_random_numbers
         self._practice_length = scenario.practice_length()
         self._target_probability = target_probability
-        self._practice = {}
+        self._practice = PracticeLog()
         self._rmse = {}
         self._jaccard = {}
         self._intersection = {}
         self._replay = {}
         self._number_of_answers = None
+        self._answer_counts = {}
+        self._answers_per_probability = {}
         self._scenario = scenario
         self._directory = None
         self._stats_loaded = False
+        self._stats_dirty = False
+        self._practice_saved = False
 
-    def simulate(self):
-        self._simulate(
-            self._practice,
-            self._practice_length,
-            recommend_fun=lambda items: recommend(items, self._target_probability))
+    def simulate(self, checkpoint_every=None):
+        """
+        Simulate the practice unless it is already simulated or loaded. If
+        the checkpoint interval is given (and the simulator is loaded from a
+        directory), a checkpoint is saved after every checkpoint_every
+        users and an interrupted simulation is resumed from the last one.
+        """
+        self._simulate(self._practice, self._practice_length, checkpoint_every=checkpoint_every)
+
+    def simulate_streaming(self, directory, chunk_size=10000, baseline=None, checkpoint=False):
+        """
+        Simulate the practice in chunks of users which are written to the
+        practice file as soon as they are produced, so at most one chunk is
+        held in memory. RMSE, answer counts and the intersection with the
+        baseline (the optimal simulator by default) are accumulated along
+        the way and saved as the stats. With checkpoint, the state of the
+        simulation is saved after every chunk and an interrupted simulation
+        is resumed from the last one.
+        """
+        self.load(directory)
+        if self.has_practice():
+            return
+        if baseline is None:
+            baseline = self._scenario.optimal_simulator(self._replica)
+        if baseline is self:
+            baseline = None
+        elif not baseline.has_practice():
+            baseline.simulate_streaming(directory, chunk_size=chunk_size, checkpoint=checkpoint)
+        if not path.exists(directory):
+            makedirs(directory)
+        practice_length = min(self._practice_length, len(self._items))
+        number_of_users = len(self._users)
+        filename = self.filename(directory) + '_practice.npy'
+        checkpoint = self._checkpoint_filename() if checkpoint else None
+        totals = self._load_checkpoint(checkpoint, ['written', 'next_user']) if checkpoint is not None else None
+        if totals is None or not path.exists(filename + '.part'):
+            totals = {
+                'written': numpy.array(0),
+                'next_user': numpy.array(0),
+                'squared_errors': numpy.zeros(practice_length),
+                'attempts': numpy.zeros(practice_length),
+                'counts': numpy.zeros(self._scenario.number_of_items(), dtype=numpy.int64),
+                'intersection_sum': numpy.zeros(practice_length),
+                'intersection_squares': numpy.zeros(practice_length),
+            }
+            output = open_practice(filename + '.part', number_of_users * practice_length)
+        else:
+            output = numpy.lib.format.open_memmap(filename + '.part', mode='r+')
+        written = int(totals['written'])
+        for chunk in self._simulate_chunks(practice_length, chunk_size=chunk_size, first_user=int(totals['next_user'])):
+            data = chunk.to_array()
+            output[written:written + len(data)] = data
+            output.flush()
+            written += len(data)
+            positions = chunk.positions()
+            totals['squared_errors'] += numpy.bincount(positions, weights=(data['prediction'] - data['correct']) ** 2, minlength=practice_length)
+            totals['attempts'] += numpy.bincount(positions, minlength=practice_length)
+            totals['counts'] += chunk.counts(len(totals['counts']))
+            if baseline is not None:
+                users = chunk.users()
+                intersection, _, _ = intersection_sizes(
+                    baseline.get_practice().user_range(users[0], users[-1] + 1).items_matrix(users, practice_length, -1),
+                    chunk.items_matrix(users, practice_length, -2))
+                totals['intersection_sum'] += intersection.sum(axis=0)
+                totals['intersection_squares'] += (intersection ** 2).sum(axis=0)
+            if checkpoint is not None and len(data) > 0:
+                totals['written'] = numpy.array(written)
+                totals['next_user'] = numpy.array(int(data['user'][-1]) + 1)
+                self._save_checkpoint(checkpoint, totals)
+        del output
+        rename(filename + '.part', filename)
+        if checkpoint is not None:
+            self._remove_checkpoint(checkpoint)
+        counts = totals['counts']
+        self._stats_dirty = True
+        self._rmse[practice_length] = math.sqrt(totals['squared_errors'].sum() / totals['attempts'].sum())
+        self._answer_counts[practice_length] = counts
+        self._number_of_answers = dict([(i, int(counts[i])) for i in self._scenario.difficulties().keys()])
+        if baseline is not None:
+            means = totals['intersection_sum'] / number_of_users
+            stds = numpy.sqrt(numpy.maximum(totals['intersection_squares'] / number_of_users - means ** 2, 0))
+            for i in range(practice_length):
+                self._intersection[i + 1] = {'mean': float(means[i]), 'std': float(stds[i])}
+        self.save(directory)
 
     def number_of_answers(self):
         if self._number_of_answers is None:
-            result = dict([(i_d[0], 0) for i_d in list(self._scenario.difficulties().items())])
-            def _reducer(acc, i):
-                acc[i] += 1
-                return acc
-            reduce(
-                _reducer,
-                [x[0] for x in [x for xs in list(self.get_practice().values()) for x in xs]], result)
-            self._number_of_answers = result
+            counts = self.answer_counts()
+            self._number_of_answers = dict([(i, int(counts[i])) for i in self._scenario.difficulties().keys()])
+            self._stats_dirty = True
         return self._number_of_answers
 
+    def answer_counts(self, practice_length=None):
+        """
+        Return an array with the number of answers for each item (indexed by
+        the item id) within the first practice_length attempts of each user.
+        """
+        if practice_length is None:
+            practice_length = self._practice_length
+        result = self._answer_counts.get(practice_length)
+        if result is None:
+            if practice_length == self._practice_length and self._number_of_answers is not None:
+                result = numpy.zeros(self._scenario.number_of_items(), dtype=numpy.int64)
+                result[list(self._number_of_answers.keys())] = list(self._number_of_answers.values())
+            else:
+                result = self.get_practice().counts(self._scenario.number_of_items(), practice_length)
+            self._answer_counts[practice_length] = result
+        return result
+
+    def answers_per_probability(self, bins=10, practice_length=None):
+        """
+        Return the number of answers in each of the equally wide bins of the
+        true probability of the correct answer, together with the bin edges.
+        """
+        if practice_length is None:
+            practice_length = self._practice_length
+        key = (bins, practice_length)
+        result = self._answers_per_probability.get(key)
+        if result is None:
+            real_predictions = self.get_practice().column('real_prediction', practice_length)
+            result = numpy.bincount(numpy.minimum((real_predictions * bins).astype(numpy.int64), bins - 1), minlength=bins)
+            self._answers_per_probability[key] = result
+        return result, numpy.linspace(0, 1, bins + 1)
+
     def jaccard(self, practice_length=None, baseline=None):
         if practice_length is None:
             practice_length = self._practice_length
         if baseline is None:
-            baseline = self._scenario.optimal_simulator()
+            baseline = self._scenario.optimal_simulator(self._replica)
         jaccard_key = '%s:%s' % (baseline.hash(), practice_length)
         result = self._jaccard.get(jaccard_key)
         if result is None:
-            jaccard = []
-            for u in range(self._scenario.number_of_users()):
-                first_set = set(list(zip(*baseline.get_practice()[u]))[0][:practice_length])
-                second_set = set(list(zip(*self.get_practice()[u]))[0][:practice_length])
-                jaccard.append(len(first_set & second_set) / float(len(first_set | second_set)))
-            jaccard_mean, jaccard_std = numpy.mean(jaccard), numpy.std(jaccard)
-            result = {'mean': jaccard_mean, 'std': jaccard_std}
-            self._jaccard[jaccard_key] = result
+            self.jaccard_curve(practice_length, baseline=baseline)
+            result = self._jaccard[jaccard_key]
         return result['mean'], result['std']
 
+    def jaccard_curve(self, practice_length=None, baseline=None):
+        """
+        Return means and standard deviations (over users) of the Jaccard
+        index between the practiced sets of the baseline and this simulator
+        for all the practice lengths 1..practice_length.
+        """
+        if practice_length is None:
+            practice_length = self._practice_length
+        if baseline is None:
+            baseline = self._scenario.optimal_simulator(self._replica)
+        intersection, first_sizes, second_sizes = self._intersection_sizes(baseline, practice_length)
+        jaccard = intersection / (first_sizes + second_sizes - intersection).astype(numpy.float64)
+        means, stds = jaccard.mean(axis=0), jaccard.std(axis=0)
+        for i in range(practice_length):
+            self._jaccard['%s:%s' % (baseline.hash(), i + 1)] = {'mean': float(means[i]), 'std': float(stds[i])}
+        self._stats_dirty = True
+        return means, stds
+
     def intersection(self, practice_length=None):
         if practice_length is None:
             practice_length = self._practice_length
         result = self._intersection.get(practice_length)
         if result is None:
-            baseline = self._scenario.optimal_simulator()
-            intersection = []
-            for u in range(self._scenario.number_of_users()):
-                first_set = set(list(zip(*baseline.get_practice()[u]))[0][:practice_length])
-                second_set = set(list(zip(*self.get_practice()[u]))[0][:practice_length])
-                intersection.append(len(first_set & second_set))
-            intersection_mean, intersection_std = numpy.mean(intersection), numpy.std(intersection)
-            result = {'mean': intersection_mean, 'std': intersection_std}
-            self._intersection[practice_length] = result
+            self.intersection_curve(practice_length)
+            result = self._intersection[practice_length]
         return result['mean'], result['std']
 
-    def save(self, directory):
-        if not path.exists(directory):
-            makedirs(directory)
-        self._save_stats(directory)
-        self._save_practice(directory)
+    def intersection_curve(self, practice_length=None):
+        """
+        Return means and standard deviations (over users) of the size of the
+        intersection between the practiced sets of the optimal simulator and
+        this simulator for all the practice lengths 1..practice_length.
+        """
+        if practice_length is None:
+            practice_length = self._practice_length
+        intersection, _, _ = self._intersection_sizes(self._scenario.optimal_simulator(self._replica), practice_length)
+        means, stds = intersection.mean(axis=0), intersection.std(axis=0)
+        for i in range(practice_length):
+            self._intersection[i + 1] = {'mean': float(means[i]), 'std': float(stds[i])}
+        self._stats_dirty = True
+        return means, stds
+
+    def user_similarity(self, practice_length=None, baseline=None):
+        """
+        Return users x practice_length matrices with the size of the
+        intersection and with the Jaccard index of the practiced sets of the
+        baseline (the optimal simulator of the same replica by default) and
+        this simulator for all the practice lengths 1..practice_length.
+        """
+        if practice_length is None:
+            practice_length = self._practice_length
+        if baseline is None:
+            baseline = self._scenario.optimal_simulator(self._replica)
+        intersection, first_sizes, second_sizes = self._intersection_sizes(baseline, practice_length)
+        return intersection, intersection / numpy.maximum(first_sizes + second_sizes - intersection, 1).astype(numpy.float64)
+
+    def user_replay_errors(self, models, warm_starts=None):
+        """
+        Replay the practice to all the given models (see replay_many) and
+        return the models x users matrix of the sums of squared errors
+        together with the numbers of attempts of the users.
+        """
+        if warm_starts is None:
+            warm_starts = [None] * len(models)
+        snapshots = [warm_start[1] if warm_start is not None else None for warm_start in warm_starts]
+        return replay_errors(self.get_practice(), models, snapshots, number_of_users=len(self._users))
+
+    def replica(self, replica):
+        """
+        Return the simulator differing from this one only by the random
+        stream of the simulation, i.e. its independent replication.
+        """
+        return Simulator(
+            self._optimal_model, self._model, self._scenario, train=self._train,
+            target_probability=self._target_probability, warm_start=self._warm_start, replica=replica,
+            common_random_numbers=self._common_random_numbers)
+
+    def save(self, directory, writer=None):
+        """
+        Save the stats and the practice unless they are already stored in
+        the directory (the one the simulator was loaded from) unchanged. The
+        files are written by the given writer (see persistence.Writer), or
+        immediately if there is none.
+        """
+        flush = writer is None
+        if flush:
+            writer = Writer()
+        self._save_stats(directory, writer)
+        self._save_practice(directory, writer)
+        if flush:
+            writer.flush()
 
     def load(self, directory):
         self._directory = directory
@@ -122,6 +393,10 @@ class Simulator:
             return self._rmse[practice_length]
         return self._compute_rmse(self._rmse, self.get_practice(), practice_length)
 
+    def has_practice(self):
+        self._load_practice()
+        return len(self._practice) > 0
+
     def get_practice(self):
         self._load_practice()
         self.simulate()
@@ -132,20 +407,47 @@ class Simulator:
             practice_length = self._practice_length
         return self._get_data(self.get_practice(), practice_length)
 
-    def replay(self, model):
-        result = self._replay.get(str(model))
-        if result is None:
-            predicted = []
-            actual = []
-            model.reset()
-            for u in sorted(self._users.keys()):
-                for item, _, correct, _ in self.get_practice()[u]:
-                    predicted.append(model.predict(u, item))
-                    model.update(u, item, correct)
-                    actual.append(correct)
-            result = rmse(predicted, actual)
-            self._replay[str(model)] = result
-        return result
+    def replay(self, model, warm_start=None):
+        return self.replay_many([model], warm_starts=[warm_start])[0]
+
+    def replay_many(self, models, warm_starts=None):
+        """
+        Replay the practice to all the given models (reset beforehand, or
+        started from the given warm starts, see Scenario.warm_start) in one
+        pass and return the list of their RMSEs.
+        """
+        if warm_starts is None:
+            warm_starts = [None] * len(models)
+        keys = [self._replay_key(model, warm_start) for model, warm_start in zip(models, warm_starts)]
+        to_replay = dict([(key, (model, warm_start)) for key, model, warm_start in zip(keys, models, warm_starts) if key not in self._replay])
+        if len(to_replay) > 0:
+            names, to_replay = list(to_replay.keys()), list(to_replay.values())
+            snapshots = [warm_start[1] if warm_start is not None else None for _, warm_start in to_replay]
+            for name, rmse in zip(names, replay_rmse(self.get_practice(), [model for model, _ in to_replay], snapshots)):
+                self._replay[name] = rmse
+            self._stats_dirty = True
+        return [self._replay[key] for key in keys]
+
+    def warm_start(self):
+        """
+        Return (key, snapshot) of the state the model starts from, or None
+        if it starts from the empty state.
+        """
+        return self._warm_start
+
+    def fit(self, model):
+        """
+        Let the model (reset beforehand) learn from the whole practice and
+        return the snapshot of its state of the items (see
+        Model.item_snapshot).
+        """
+        if model.item_snapshot() is None:
+            raise ValueError("The model '%s' does not support snapshots." % model)
+        replay_rmse(self.get_practice(), [model])
+        return model.item_snapshot()
+
+    def items(self):
+        return self._items
 
     def filename(self, directory):
         return directory + '/' + self.hash()
@@ -153,25 +455,37 @@ class Simulator:
     def hash(self):
         return hashlib.sha1(str(self).encode()).hexdigest()
 
-    def _save_practice(self, directory):
-        filename = self.filename(directory) + '_practice.json'
-        if path.exists(filename) or len(self._practice) == 0:
+    def _save_practice(self, directory, writer):
+        if len(self._practice) == 0 or (self._practice_saved and directory == self._directory):
             return
-        to_json = {
-            'practice': self._practice,
-        }
-        with open(filename, 'w') as f:
-            json.dump(to_json, f)
+        filename = self.filename(directory) + '_practice.npy'
+        json_filename = self.filename(directory) + '_practice.json'
+        if path.exists(json_filename):
+            # migrate the legacy cache, which is removed only once the
+            # binary one is written
+            if not path.exists(filename):
+                atomic_write(filename, self._practice.to_array())
+            remove(json_filename)
+        elif not path.exists(filename):
+            writer.write(filename, self._practice.to_array())
+        if directory == self._directory:
+            self._practice_saved = True
 
     def _load_practice(self):
         if self._directory is None or len(self._practice) > 0:
             return
-        filename = self.filename(self._directory) + '_practice.json'
-        if not path.exists(filename):
+        filename = self.filename(self._directory) + '_practice.npy'
+        if path.exists(filename):
+            self._practice = load_practice(filename)
+            self._practice_saved = True
             return
-        with open(filename, 'r') as f:
+        json_filename = self.filename(self._directory) + '_practice.json'
+        if not path.exists(json_filename):
+            return
+        with open(json_filename, 'r') as f:
             to_json = json.loads(f.read())
-            self._practice = convert_dict(to_json['practice'], int, list)
+            self._practice = PracticeLog.from_dict(convert_dict(to_json['practice'], int, list))
+        # the cache is migrated to the binary format on save
 
     def _load_stats(self):
         if self._directory is None or self._stats_loaded:
@@ -188,8 +502,11 @@ class Simulator:
             if 'number_of_answers' in to_json:
                 self._number_of_answers = convert_dict(to_json['number_of_answers'], int, int)
             self._stats_loaded = True
+            self._stats_dirty = False
 
-    def _save_stats(self, directory):
+    def _save_stats(self, directory, writer):
+        if not self._stats_dirty and directory == self._directory:
+            return
         to_json = {
             'str': str(self),
             'model': str(self._model),
@@ -200,39 +517,217 @@ class Simulator:
         }
         if self._number_of_answers is not None:
             to_json['number_of_answers'] = self._number_of_answers
-        filename = self.filename(directory) + '_stats.json'
-        with open(filename, 'w') as f:
-            json.dump(to_json, f)
+        writer.write(self.filename(directory) + '_stats.json', json.dumps(to_json))
+        if directory == self._directory:
+            self._stats_dirty = False
 
     def __str__(self):
-        return 'simulator, model: %s, practice length: %s, train: %s, target prob: %.2f' % (
+        result = 'simulator, model: %s, practice length: %s, train: %s, target prob: %.2f' % (
             str(self._model), self._practice_length, self._train, self._target_probability)
+        if self._warm_start is not None:
+            result += ', warm start: %s' % self._warm_start[0]
+        if self._replica != 0:
+            result += ', replica: %s' % self._replica
+        if self._common_random_numbers:
+            result += ', common random numbers: %s' % self._common_key() if self._train else ', common random numbers'
+        return result
+
+    def _replay_key(self, model, warm_start):
+        if warm_start is None:
+            return str(model)
+        return '%s, warm start: %s' % (model, warm_start[0])
 
     def _get_data(self, practice, practice_length):
-        return [(u, p[0], p[2]) for u, ps in practice.items() for p in ps[:practice_length]]
+        return list(zip(*[practice.column(c, practice_length).tolist() for c in ['user', 'item', 'correct']]))
 
-    def _simulate(self, storage, practice_length, number_of_users=None, recommend_fun=recommend):
+    def _simulate(self, storage, practice_length, number_of_users=None, recommendation_fun=recommendation, checkpoint_every=None):
         if len(storage) > 0:
             return
-        self._model.reset()
-        for u in range(len(self._users)):
-            item_ids = set(self._items.keys())
-            storage[u] = []
-            for p in range(practice_length):
-                predictions = dict([(i, self._model.predict(u, i)) for i in item_ids])
-                to_practice = recommend_fun(predictions)
-                real_prediction = self._optimal_model.predict(u, to_practice)
-                correct = numpy.random.uniform(0, 1) < real_prediction
-                self._model.update(u, to_practice, correct)
-                storage[u].append((to_practice, predictions[to_practice], correct, real_prediction))
-                item_ids.remove(to_practice)
-            if number_of_users is not None and u >= number_of_users - 1:
-                break
+        checkpoint = self._checkpoint_filename() if checkpoint_every is not None else None
+        first_user = 0
+        if checkpoint is not None:
+            first_user = self._resume(checkpoint, storage)
+        for chunk in self._simulate_chunks(
+                practice_length, chunk_size=checkpoint_every, number_of_users=number_of_users,
+                recommendation_fun=recommendation_fun, first_user=first_user):
+            data = chunk.to_array()
+            storage.extend(*[data[name] for name in PRACTICE_DTYPE.names])
+            if checkpoint is not None and len(data) > 0:
+                if not path.exists(self._directory):
+                    makedirs(self._directory)
+                # the practice is appended first, so the rows of an
+                # unfinished checkpoint are cut off when resuming
+                with open(checkpoint + '_practice.bin', 'ab') as f:
+                    data.tofile(f)
+                    f.flush()
+                    fsync(f.fileno())
+                self._save_checkpoint(checkpoint, {
+                    'next_user': numpy.array(int(data['user'][-1]) + 1),
+                    'rows': numpy.array(len(storage)),
+                })
+        if checkpoint is not None:
+            self._remove_checkpoint(checkpoint)
+
+    def _checkpoint_filename(self):
+        if self._directory is None or self._model.snapshot() is None:
+            return None
+        return self.filename(self._directory) + '_checkpoint'
+
+    def _save_checkpoint(self, filename, state):
+        arrays = dict([('model__' + key, value) for key, value in self._model.snapshot().items()])
+        arrays.update(state)
+        atomic_write(filename + '.npz', arrays)
+
+    def _load_checkpoint(self, filename, keys):
+        """
+        Restore the model from the checkpoint and return the rest of its
+        state, or None if there is no checkpoint with the given keys.
+        """
+        if not path.exists(filename + '.npz'):
+            return None
+        with numpy.load(filename + '.npz') as data:
+            arrays = dict([(name, data[name]) for name in data.files])
+        if any([key not in arrays for key in keys]):
+            return None
+        self._model.restore(dict([(name[len('model__'):], value) for name, value in arrays.items() if name.startswith('model__')]))
+        return dict([(name, value) for name, value in arrays.items() if not name.startswith('model__')])
+
+    def _resume(self, checkpoint, storage):
+        """
+        Load the practice and the model saved in the checkpoint and return
+        the user the simulation continues with.
+        """
+        state = self._load_checkpoint(checkpoint, ['next_user', 'rows'])
+        if state is None or not path.exists(checkpoint + '_practice.bin'):
+            self._remove_checkpoint(checkpoint)
+            return 0
+        rows = int(state['rows'])
+        with open(checkpoint + '_practice.bin', 'r+b') as f:
+            f.truncate(rows * PRACTICE_DTYPE.itemsize)
+        data = numpy.fromfile(checkpoint + '_practice.bin', dtype=PRACTICE_DTYPE, count=rows)
+        storage.extend(*[data[name] for name in PRACTICE_DTYPE.names])
+        return int(state['next_user'])
+
+    def _remove_checkpoint(self, checkpoint):
+        for filename in [checkpoint + '.npz', checkpoint + '_practice.bin']:
+            if path.exists(filename):
+                remove(filename)
+
+    def _simulate_chunks(self, practice_length, chunk_size=None, number_of_users=None, recommendation_fun=recommendation, first_user=0):
+        """
+        Simulate the practice and yield it as practice logs of consecutive
+        chunks of users. If the first user is not 0, the simulation
+        continues from the current state of the model (restored from a
+        checkpoint).
+        """
+        if first_user == 0:
+            self._model.reset()
+            if self._warm_start is not None:
+                self._model.restore(self._warm_start[1])
+        if number_of_users is None or number_of_users > len(self._users):
+            number_of_users = len(self._users)
+        if chunk_size is None:
+            chunk_size = max(1, number_of_users)
+        if not self._model.learns():
+            for start in range(first_user, number_of_users, chunk_size):
+                yield self._simulate_lockstep(numpy.arange(start, min(start + chunk_size, number_of_users)), practice_length)
+            return
+        engine = recommendation_fun(self._model, list(self._items.keys()), self._target_probability)
+        common_seed = self._common_seed()
+        random_generators = self._random_generators()
+        for start in range(first_user, number_of_users, chunk_size):
+            chunk = PracticeLog(min(chunk_size, number_of_users - start) * practice_length)
+            for u in range(start, min(start + chunk_size, number_of_users)):
+                random_generator = random_generators(u)
+                engine.start(u, random_generator)
+                for p in range(practice_length):
+                    to_practice, prediction = engine.recommend(u)
+                    real_prediction = self._optimal_model.predict(u, to_practice)
+                    if common_seed is None:
+                        correct = random_generator.random() < real_prediction
+                    else:
+                        correct = float(common_uniforms(common_seed, u, to_practice)) < real_prediction
+                    engine.update(u, to_practice, correct)
+                    chunk.append(u, to_practice, prediction, correct, real_prediction)
+            yield chunk
+
+    def _simulate_lockstep(self, users, practice_length, chunk_cells=10 ** 7):
+        """
+        Simulate the given users at once, which is possible only for models
+        which do not learn. In that case the predictions are fixed, so each
+        user practices items in the order of decreasing prediction score
+        (ties broken by random priorities). The random numbers are drawn
+        from the per-user streams in the same order as in the step by step
+        simulation, so the results are identical.
+        """
+        common_seed = self._common_seed()
+        random_generators = self._random_generators()
+        items = numpy.array(sorted(self._items.keys()), dtype=numpy.int64)
+        practice_length = min(practice_length, len(items))
+        result = PracticeLog(len(users) * practice_length)
+        chunk_size = max(1, chunk_cells // max(1, len(items)))
+        for start in range(0, len(users), chunk_size):
+            chunk = users[start:start + chunk_size]
+            predictions = self._model.predict_matrix(chunk, items)
+            scores = prediction_score(predictions, self._target_probability)
+            priorities = numpy.empty(scores.shape)
+            uniforms = numpy.empty((len(chunk), practice_length))
+            for row, u in enumerate(chunk.tolist()):
+                random_generator = random_generators(u)
+                priorities[row] = random_generator.random(len(items))
+                if common_seed is None:
+                    uniforms[row] = random_generator.random(practice_length)
+            order = numpy.lexsort((-priorities, -scores), axis=1)[:, :practice_length]
+            to_practice = items[order]
+            if common_seed is not None:
+                uniforms = common_uniforms(common_seed, chunk[:, None], to_practice)
+            real_predictions = numpy.take_along_axis(self._optimal_model.predict_matrix(chunk, items), order, axis=1)
+            corrects = uniforms < real_predictions
+            result.extend(
+                numpy.repeat(chunk, practice_length),
+                to_practice.ravel(),
+                numpy.take_along_axis(predictions, order, axis=1).ravel(),
+                corrects.ravel(),
+                real_predictions.ravel())
+        return result
+
+    def _random_generators(self):
+        """
+        Return a function returning the random generator of the given user in
+        this simulator (the same in all the simulators of the replica with
+        common random numbers), independent of the order in which the users
+        are simulated.
+        """
+        if self._common_random_numbers:
+            return self._scenario.random_generators(self._common_key(), self._replica)
+        return self._scenario.random_generators('simulator', self.hash())
+
+    def _common_seed(self):
+        """
+        Return the seed of the uniform numbers deciding the correctness of
+        the answers (see model.common_uniforms) shared by all the simulators
+        of the replica, or None if the simulator has its own random numbers.
+        """
+        if not self._common_random_numbers:
+            return None
+        return int(self._scenario.random_generator(self._common_key(), self._replica).integers(2 ** 63))
+
+    def _common_key(self):
+        return 'common_train' if self._train else 'common'
+
+    def _intersection_sizes(self, baseline, practice_length):
+        """
+        Return users x practice_length arrays with the size of the
+        intersection of the practiced sets of the baseline and this simulator
+        and with the sizes of both the practiced sets for every prefix length.
+        """
+        users = list(range(self._scenario.number_of_users()))
+        return intersection_sizes(
+            baseline.get_practice().items_matrix(users, practice_length, -1),
+            self.get_practice().items_matrix(users, practice_length, -2))
 
     def _compute_rmse(self, storage, practice, practice_length):
         if storage.get(practice_length) is None:
-            flat_practice = [x for xs in list(practice.values()) for x in xs[:practice_length]]
-            storage[practice_length] = rmse(list(zip(*flat_practice))[1], list(zip(*flat_practice))[2])
+            storage[practice_length] = practice.rmse(practice_length)
+            self._stats_dirty = True
         return storage[practice_length]
-
-
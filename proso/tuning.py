@@ -0,0 +1,110 @@
+from .model import ClusterEloModel
+from .practice import load_practice
+from .simulator import replay_rmse
+from multiprocessing import Pool
+import csv
+import itertools
+import json
+import math
+import numpy
+
+
+_WORKER = {}
+
+
+def grid_candidates(alphas, betas):
+    return [{'alpha': float(alpha), 'beta': float(beta)} for alpha, beta in itertools.product(alphas, betas)]
+
+
+def random_candidates(alpha_range, beta_range, number, random_generator):
+    """
+    Sample the given number of candidates, alpha uniformly and beta (which
+    spans orders of magnitude) log-uniformly from the given ranges.
+    """
+    alphas = random_generator.uniform(alpha_range[0], alpha_range[1], size=number)
+    log_betas = random_generator.uniform(math.log(beta_range[0]), math.log(beta_range[1]), size=number)
+    return [{'alpha': float(alpha), 'beta': float(beta)} for alpha, beta in zip(alphas, numpy.exp(log_betas))]
+
+
+def halving_budgets(number_of_candidates, number_of_users, eta=3, min_users=10):
+    """
+    Return the increasing numbers of users the candidates are evaluated on
+    in the rounds of successive halving, the last round uses all the users.
+    """
+    rounds = max(1, int(math.ceil(math.log(max(number_of_candidates, 1), eta))) + 1)
+    budgets = [number_of_users]
+    while len(budgets) < rounds and budgets[0] // eta >= min_users:
+        budgets.insert(0, budgets[0] // eta)
+    return budgets
+
+
+def tune(scenario, directory, practice_files, with_clusters, candidates, jobs=1, eta=3, min_users=10, progress=None):
+    """
+    Search for the parameters of ClusterEloModel (with or without the
+    clusters) minimizing the mean RMSE over the given cached practice
+    files. The candidates are replayed on the practice of the first users
+    only and the worst ones are pruned (successive halving), the survivors
+    are evaluated on more users in the next round. Return the list of the
+    results (dicts with the parameters, the number of users and the RMSE)
+    of all the rounds, the best candidate of the last round goes first.
+    """
+    budgets = halving_budgets(len(candidates), scenario.number_of_users(), eta=eta, min_users=min_users)
+    config = scenario._data['config']
+    survivors = list(candidates)
+    results = []
+    pool = Pool(jobs) if jobs > 1 else None
+    try:
+        for round_number, users in enumerate(budgets):
+            tasks = [(config, directory, practice_files, with_clusters, candidate, users) for candidate in survivors]
+            rmses = pool.map(_evaluate, tasks) if pool is not None else list(map(_evaluate, tasks))
+            round_results = sorted(
+                [dict(candidate, users=users, round=round_number, rmse=rmse) for candidate, rmse in zip(survivors, rmses)],
+                key=lambda r: r['rmse'])
+            results = round_results + results
+            if progress is not None:
+                progress(round_number, users, round_results)
+            survivors = [dict(alpha=r['alpha'], beta=r['beta']) for r in round_results[:max(1, len(round_results) // eta)]]
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    return results
+
+
+def save_results(results, filename):
+    """
+    Save the best parameters to the JSON file and the table of all the
+    results to the CSV file with the same name.
+    """
+    with open(filename + '.json', 'w') as f:
+        json.dump({'best': {'alpha': results[0]['alpha'], 'beta': results[0]['beta']}, 'results': results}, f, indent=2)
+    with open(filename + '.csv', 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=['round', 'users', 'alpha', 'beta', 'rmse'])
+        writer.writeheader()
+        writer.writerows(results)
+
+
+def _evaluate(task):
+    config, directory, practice_files, with_clusters, candidate, users = task
+    from .scenario import Scenario
+    key = json.dumps(config, sort_keys=True)
+    if _WORKER.get('key') != key:
+        scenario = Scenario(dict(config))
+        scenario.load(directory)
+        _WORKER.clear()
+        _WORKER['key'] = key
+        _WORKER['scenario'] = scenario
+        _WORKER['practice'] = {}
+    scenario = _WORKER['scenario']
+    model = ClusterEloModel(
+        scenario,
+        clusters=scenario.clusters() if with_clusters else {},
+        alpha=candidate['alpha'],
+        dynamic_alpha=candidate['beta'])
+    rmses = []
+    for filename in practice_files:
+        practice = _WORKER['practice'].get(filename)
+        if practice is None:
+            practice = _WORKER['practice'][filename] = load_practice(filename)
+        rmses.append(replay_rmse(practice.user_range(0, users), [model])[0])
+    return float(numpy.mean(rmses))
@@ -1,5 +1,6 @@
-from sklearn.metrics import mean_squared_error
+from collections.abc import Mapping
 import math
+import numpy
 
 
 def running_fun(xs, fun):
@@ -16,8 +17,54 @@ def window_fun(xs, fun, size):
 
 
 def rmse(xs, ys):
-    return math.sqrt(mean_squared_error(xs, ys))
+    return math.sqrt(numpy.mean((numpy.asarray(xs, dtype=float) - numpy.asarray(ys, dtype=float)) ** 2))
 
 
 def convert_dict(json_dict, key_type, value_type):
     return dict([(key_type(k_v[0]), value_type(k_v[1])) for k_v in list(json_dict.items())])
+
+
+class ArrayDict(Mapping):
+    """
+    Read-only dict-like view of an array keyed by the indices along its
+    first axis, so the code expecting {id: value} dicts keeps working with
+    data held in arrays. The underlying array is available as .array.
+    """
+
+    def __init__(self, array):
+        self.array = array
+
+    def __getitem__(self, key):
+        if not 0 <= key < len(self.array):
+            raise KeyError(key)
+        if self.array.ndim == 1:
+            return self.array[key].item()
+        return self.array[key]
+
+    def __iter__(self):
+        return iter(range(len(self.array)))
+
+    def __len__(self):
+        return len(self.array)
+
+    def __contains__(self, key):
+        return isinstance(key, (int, numpy.integer)) and 0 <= key < len(self.array)
+
+    def keys(self):
+        return range(len(self.array))
+
+    def values(self):
+        return self.array.tolist() if self.array.ndim == 1 else list(self.array)
+
+    def items(self):
+        return zip(self.keys(), self.values())
+
+
+def dict_to_array(values, dtype):
+    """
+    Turn a dict keyed by consecutive non-negative integers (or an ArrayDict)
+    into an array indexed by the keys.
+    """
+    if isinstance(values, ArrayDict):
+        return numpy.asarray(values.array, dtype=dtype)
+    return numpy.array([values[key] for key in range(len(values))], dtype=dtype)
@@ -1,9 +1,13 @@
 from argparse import ArgumentParser
 from os import path, makedirs
+import copy
+import time
+import proso.metrics
+import proso.parallel
+import proso.persistence
 import proso.scenario
+import proso.profiling
 from proso.model import ClusterEloModel, NaiveModel, ConstantModel
-from proso.plots import plot_intersection, plot_rmse_complex, plot_number_of_answers_per_difficulty, plot_noise_vs_intersection_number_of_answers, plot_number_of_answers_distribution
-import matplotlib.pyplot as plt
 
 
 VERSION = 1
@@ -21,8 +25,9 @@ def parser_init():
         '-n',
         '--name',
         metavar='SCENARIO',
+        nargs='+',
         required=True,
-        help='name of the scenario to be executed')
+        help='names of the scenarios to be executed, or "all" for all the scenarios from the settings')
     parser.add_argument(
         '-d',
         '--destination',
@@ -46,56 +51,235 @@ def parser_init():
         action='store_true',
         dest='skip_cache',
         help='skip saving the cache')
+    parser.add_argument(
+        '-j',
+        '--jobs',
+        metavar='N',
+        type=int,
+        default=1,
+        dest='jobs',
+        help='number of processes used to simulate the scenarios (and plot them in the batch mode)')
+    parser.add_argument(
+        '--chunk-size',
+        metavar='USERS',
+        type=int,
+        dest='chunk_size',
+        help='simulate in the streaming mode writing practice of the given number of users at once')
+    parser.add_argument(
+        '--checkpoint',
+        metavar='USERS',
+        type=int,
+        dest='checkpoint',
+        help='save a checkpoint of each simulation after the given number of users (after each chunk in the streaming mode), an interrupted simulation resumes from it')
+    parser.add_argument(
+        '--replicas',
+        metavar='N',
+        type=int,
+        dest='replicas',
+        help='simulate every simulator with N independent random streams and compute the bootstrap confidence intervals of the intersection and RMSE (drawn as error bands)')
+    parser.add_argument(
+        '--resamples',
+        metavar='N',
+        type=int,
+        dest='resamples',
+        default=1000,
+        help='number of bootstrap resamples of the confidence intervals')
+    parser.add_argument(
+        '--common-random-numbers',
+        action='store_true',
+        dest='common_random_numbers',
+        help='let all the simulators of a scenario share the random numbers (the same answer of a user to an item is correct in all of them), so the differences between the models are less noisy')
+    parser.add_argument(
+        '--warm-start',
+        action='store_true',
+        dest='warm_start',
+        help='start the learning models from the state of the items fitted on the practice of the train users on the test items (cached in the destination directory)')
+    parser.add_argument(
+        '--profile',
+        action='store_true',
+        dest='profile',
+        help='measure the phases of the run and save the report to the destination directory')
+    parser.add_argument(
+        '--profile-phase',
+        metavar='PHASE',
+        dest='profile_phase',
+        help='capture the given phase (e.g. Simulator.simulate) by cProfile')
+    parser.add_argument(
+        '--profile-memory',
+        action='store_true',
+        dest='profile_memory',
+        help='capture the phase given by --profile-phase by tracemalloc instead of cProfile')
+    parser.add_argument(
+        '--no-plots',
+        action='store_true',
+        dest='no_plots',
+        help='do not import the plotting libraries, only export the metrics behind the figures to JSON and CSV files')
     return parser
 
 
 def savefig(args, scenario, name):
+    import matplotlib.pyplot as plt
     if not path.exists(scenario.filename(args.destination)):
         makedirs(scenario.filename(args.destination))
     filename = scenario.filename(args.destination) + '/' + name + '.' + args.output
-    plt.tight_layout()
-    plt.savefig(filename, bbox_inches='tight')
+    with proso.profiling.phase('savefig'):
+        plt.tight_layout()
+        plt.savefig(filename, bbox_inches='tight')
     print(' -- saving', filename)
     plt.close()
 
 
-def main():
-    args = parser_init().parse_args()
-    if not path.exists(args.destination):
-        makedirs(args.destination)
-    scenario = proso.scenario.load_scenario(args.settings, args.name, VERSION)
-    scenario.load(args.destination)
-
-    clusters = scenario.clusters()
-
-    simulators = {
-        'Optimal': scenario.optimal_simulator(),
-        'Elo': scenario.init_simulator(args.destination, ClusterEloModel(scenario, clusters={})),
-        'Elo, Concepts': scenario.init_simulator(args.destination, ClusterEloModel(scenario, clusters=clusters)),
-        'Elo, Concepts (wrong)': scenario.init_simulator(args.destination, ClusterEloModel(scenario, clusters=clusters, number_of_items_with_wrong_cluster=scenario.number_of_items_with_wrong_cluster())),
-        'Naive': scenario.init_simulator(args.destination, NaiveModel()),
-        'Constant': scenario.init_simulator(args.destination, ConstantModel(constant=scenario.target_probability()))
-    }
+def plot_all(args, scenario, simulators, replicas=None):
+    from proso.plots import plot_intersection, plot_rmse_complex, plot_number_of_answers_per_difficulty, plot_noise_vs_intersection_number_of_answers, plot_number_of_answers_distribution
+    import matplotlib.pyplot as plt
     if args.skip_groups is None or 'common' not in args.skip_groups:
-        plot_intersection(scenario, simulators)
+        intervals = None
+        if replicas is not None:
+            with proso.profiling.phase('confidence_intervals'):
+                intervals = proso.metrics.confidence_intervals(scenario, replicas, resamples=args.resamples)
+        with proso.profiling.phase('plot_intersection'):
+            plot_intersection(scenario, simulators, bands=None if intervals is None else intervals['intersection'])
         savefig(args, scenario, 'intersection')
         plt.gcf().set_size_inches(14, 4)
-        plot_rmse_complex(scenario, simulators)
+        with proso.profiling.phase('plot_rmse_complex'):
+            plot_rmse_complex(scenario, simulators, bands=None if intervals is None else intervals['rmse'])
         savefig(args, scenario, 'rmse_complex')
         plt.gcf().set_size_inches(14, 4)
-        plot_number_of_answers_per_difficulty(scenario, simulators),
+        with proso.profiling.phase('plot_number_of_answers_per_difficulty'):
+            plot_number_of_answers_per_difficulty(scenario, simulators),
         savefig(args, scenario, 'number_of_answers')
 
     if args.skip_groups is None or 'noise' not in args.skip_groups:
         plt.gcf().set_size_inches(14, 4)
         plt.subplot(121)
-        plot_noise_vs_intersection_number_of_answers(scenario, simulators['Optimal'], args.destination)
+        with proso.profiling.phase('plot_noise_vs_intersection_number_of_answers'):
+            plot_noise_vs_intersection_number_of_answers(scenario, simulators['Optimal'], args.destination)
         plt.subplot(122)
-        plot_number_of_answers_distribution(scenario, simulators)
+        with proso.profiling.phase('plot_number_of_answers_distribution'):
+            plot_number_of_answers_distribution(scenario, simulators)
         savefig(args, scenario, 'noise_vs_intersection_number_of_answers')
+
+
+def init_simulators(args, scenario):
+    clusters = scenario.clusters()
+    warm_start = scenario.train_simulator() if getattr(args, 'warm_start', False) else None
+    simulators = {
+        'Optimal': scenario.optimal_simulator(),
+        'Elo': scenario.init_simulator(args.destination, ClusterEloModel(scenario, clusters={}), warm_start=warm_start),
+        'Elo, Concepts': scenario.init_simulator(args.destination, ClusterEloModel(scenario, clusters=clusters), warm_start=warm_start),
+        'Elo, Concepts (wrong)': scenario.init_simulator(args.destination, ClusterEloModel(scenario, clusters=clusters, number_of_items_with_wrong_cluster=scenario.number_of_items_with_wrong_cluster()), warm_start=warm_start),
+        'Naive': scenario.init_simulator(args.destination, NaiveModel(), warm_start=warm_start),
+        'Constant': scenario.init_simulator(args.destination, ConstantModel(constant=scenario.target_probability()))
+    }
+    return simulators
+
+
+def run_scenario(args, scenario):
+    scenario.load(args.destination)
+    simulators = init_simulators(args, scenario)
+    replicas = None
+    if args.replicas is not None:
+        replicas = proso.metrics.replicate(scenario, simulators, args.destination, args.replicas)
+    if args.jobs > 1 or args.chunk_size is not None or args.checkpoint is not None:
+        if args.skip_groups is None or 'noise' not in args.skip_groups:
+            proso.metrics.noise_simulators(scenario, args.destination)
+        scenario.simulate(
+            args.destination, jobs=args.jobs, chunk_size=args.chunk_size, checkpoint_every=args.checkpoint, save=not args.skip_cache)
+    if args.no_plots:
+        with proso.profiling.phase('metrics'):
+            metrics = proso.metrics.compute_all(
+                scenario, simulators, args.destination, skip_groups=args.skip_groups, replicas=replicas, resamples=args.resamples)
+        for filename in proso.metrics.export(metrics, scenario.filename(args.destination)):
+            print(' -- saving', filename)
+    else:
+        plot_all(args, scenario, simulators, replicas=replicas)
     if not args.skip_cache:
         scenario.save(args.destination)
 
 
+def run_batch(args, scenarios):
+    """
+    Simulate all the scenarios in one pool of processes (the longest
+    simulations first) and then plot them in the same pool. Without the
+    cache, the simulations cannot be handed over to the plotting, so each
+    scenario is simulated by the process plotting it.
+    """
+    scenarios = sorted(scenarios, key=lambda s: -s.cost())
+    timings = dict([(scenario.name(), 0.0) for scenario in scenarios])
+    batch = []
+    for scenario in scenarios:
+        scenario.load(args.destination)
+        simulators = init_simulators(args, scenario)
+        if args.replicas is not None:
+            proso.metrics.replicate(scenario, simulators, args.destination, args.replicas)
+        if args.skip_groups is None or 'noise' not in args.skip_groups:
+            proso.metrics.noise_simulators(scenario, args.destination)
+        if args.chunk_size is None and not args.skip_cache:
+            batch.append((scenario, scenario.pending_simulators(args.destination)))
+
+    def _progress(scenario, simulator, done, total, seconds):
+        if not args.skip_cache:
+            simulator.save(scenario.filename(args.destination), writer)
+        timings[scenario.name()] += seconds
+        print(' -- simulated [%s/%s] %s: %s (%.2f s)' % (done, total, scenario.name(), simulator._model, seconds))
+
+    finish_args = copy.copy(args)
+    finish_args.jobs = 1
+    tasks = [(finish_args, scenario._data['config']) for scenario in scenarios]
+    start = time.perf_counter()
+    pool = proso.parallel.create_pool(args.jobs) if args.jobs > 1 else None
+    writer = proso.persistence.Writer(background=True)
+    try:
+        with proso.profiling.phase('simulate'):
+            proso.parallel.simulate_batch(batch, pool=pool, progress=_progress, checkpoint_every=args.checkpoint)
+        if not args.skip_cache:
+            for scenario in scenarios:
+                scenario.save(args.destination, writer)
+        writer.close()
+        finished = pool.imap_unordered(_run_batch_scenario, tasks) if pool is not None else map(_run_batch_scenario, tasks)
+        for done, (name, seconds) in enumerate(finished):
+            timings[name] += seconds
+            print(' -- finished [%s/%s] %s (%.2f s)' % (done + 1, len(tasks), name, seconds))
+    finally:
+        writer.close()
+        if pool is not None:
+            pool.close()
+            pool.join()
+    print('%-30s %10s' % ('scenario', 'time [s]'))
+    for scenario in scenarios:
+        print('%-30s %10.2f' % (scenario.name(), timings[scenario.name()]))
+    print('%-30s %10.2f' % ('total (wall)', time.perf_counter() - start))
+
+
+def _run_batch_scenario(task):
+    args, config = task
+    start = time.perf_counter()
+    scenario = proso.scenario.Scenario(copy.deepcopy(config), version=VERSION, common_random_numbers=args.common_random_numbers)
+    run_scenario(args, scenario)
+    return scenario.name(), time.perf_counter() - start
+
+
+def main():
+    args = parser_init().parse_args()
+    if not path.exists(args.destination):
+        makedirs(args.destination)
+    scenarios = proso.scenario.load_scenarios(args.settings, args.name, VERSION, common_random_numbers=args.common_random_numbers)
+    if args.profile:
+        proso.profiling.enable(
+            directory=args.destination if len(scenarios) > 1 else scenarios[0].filename(args.destination),
+            capture=args.profile_phase,
+            capture_mode='tracemalloc' if args.profile_memory else 'cprofile')
+    if len(scenarios) > 1:
+        run_batch(args, scenarios)
+        profile_filename = args.destination + '/profile.json'
+    else:
+        run_scenario(args, scenarios[0])
+        profile_filename = scenarios[0].filename(args.destination) + '/profile.json'
+    if args.profile:
+        proso.profiling.save_report(profile_filename)
+        print(proso.profiling.format_report())
+        print(' -- saving', profile_filename)
+
+
 if __name__ == "__main__":
     main()
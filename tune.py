@@ -0,0 +1,128 @@
+from argparse import ArgumentParser
+from os import path, makedirs
+import proso.scenario
+import proso.tuning
+from run import VERSION, init_simulators
+
+
+PARAMETER_KEYS = {'elo': False, 'elo_clusters': True}
+
+
+def parser_init():
+    parser = ArgumentParser()
+    parser.add_argument(
+        '-s',
+        '--settings',
+        metavar='FILE',
+        required=True,
+        help='path to the JSON file with settings')
+    parser.add_argument(
+        '-n',
+        '--name',
+        metavar='SCENARIO',
+        required=True,
+        help='name of the scenario whose cached practice is used')
+    parser.add_argument(
+        '-d',
+        '--destination',
+        metavar='DIR',
+        required=True,
+        help='path to the directory with the cached data (the results are saved there as well)')
+    parser.add_argument(
+        '-m',
+        '--models',
+        metavar='KEY',
+        nargs='+',
+        choices=sorted(PARAMETER_KEYS.keys()),
+        default=sorted(PARAMETER_KEYS.keys()),
+        help='parameters to be tuned, elo (without clusters) and/or elo_clusters')
+    parser.add_argument(
+        '--data',
+        metavar='SIMULATOR',
+        nargs='+',
+        default=['Optimal'],
+        help='simulators (as named in run.py) whose practice the candidates are replayed on')
+    parser.add_argument(
+        '--alpha',
+        metavar='VALUE',
+        type=float,
+        nargs='+',
+        default=[0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.8, 1.0, 1.2],
+        help='values of alpha for the grid search (the range for the random search)')
+    parser.add_argument(
+        '--beta',
+        metavar='VALUE',
+        type=float,
+        nargs='+',
+        default=[0.0025, 0.005, 0.01, 0.02, 0.04, 0.08, 0.16],
+        help='values of beta for the grid search (the range for the random search)')
+    parser.add_argument(
+        '--random',
+        metavar='N',
+        type=int,
+        help='sample the given number of candidates randomly instead of the grid search')
+    parser.add_argument(
+        '--eta',
+        metavar='N',
+        type=int,
+        default=3,
+        help='only the best 1/eta of the candidates survive each round')
+    parser.add_argument(
+        '--min-users',
+        metavar='N',
+        type=int,
+        default=10,
+        dest='min_users',
+        help='minimal number of users the candidates are evaluated on')
+    parser.add_argument(
+        '-j',
+        '--jobs',
+        metavar='N',
+        type=int,
+        default=1,
+        dest='jobs',
+        help='number of processes used to replay the candidates')
+    return parser
+
+
+def main():
+    args = parser_init().parse_args()
+    scenario = proso.scenario.load_scenario(args.settings, args.name, VERSION)
+    scenario.load(args.destination)
+    if not path.exists(scenario.filename(args.destination)):
+        makedirs(scenario.filename(args.destination))
+    simulators = init_simulators(args, scenario)
+    practice_files = []
+    for name in args.data:
+        simulator = simulators[name]
+        simulator.load(scenario.filename(args.destination))
+        simulator.get_practice()
+        simulator.save(scenario.filename(args.destination))
+        practice_files.append(simulator.filename(scenario.filename(args.destination)) + '_practice.npy')
+    scenario.save(args.destination)
+    if args.random is not None:
+        candidates = proso.tuning.random_candidates(
+            (min(args.alpha), max(args.alpha)),
+            (min(args.beta), max(args.beta)),
+            args.random,
+            scenario.random_generator('tuning'))
+    else:
+        candidates = proso.tuning.grid_candidates(args.alpha, args.beta)
+
+    def _progress(round_number, users, results):
+        print(' -- round %s: %s candidates on %s users, best rmse %.5f (alpha: %.4f, beta: %.4f)' % (
+            round_number, len(results), users, results[0]['rmse'], results[0]['alpha'], results[0]['beta']))
+
+    for key in args.models:
+        print(' -- tuning', key)
+        results = proso.tuning.tune(
+            scenario, args.destination, practice_files, PARAMETER_KEYS[key], candidates,
+            jobs=args.jobs, eta=args.eta, min_users=args.min_users, progress=_progress)
+        filename = scenario.filename(args.destination) + '/tuning_' + key
+        proso.tuning.save_results(results, filename)
+        print(' -- best %s: "%s": {"alpha": %s, "beta": %s}' % (key, key, results[0]['alpha'], results[0]['beta']))
+        print(' -- saving', filename + '.json', filename + '.csv')
+
+
+if __name__ == "__main__":
+    main()